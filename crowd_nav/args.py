@@ -3,7 +3,7 @@ import argparse
 class Parser:
     def __init__(self,mode='train'):
         self.parser = argparse.ArgumentParser(description="Arguments for training, test, or plotting")
-        available_modes = ['train', 'test', 'plot']
+        available_modes = ['train', 'test', 'serve', 'distill', 'plot']
 
         if mode == 'train' or mode == 'test':
             self.parser.add_argument('--env_config', type=str, default='configs/env.config')
@@ -26,6 +26,42 @@ class Parser:
                 self.parser.add_argument('--circle', default=False, action='store_true')
                 self.parser.add_argument('--video_file', type=str, default=None)
                 self.parser.add_argument('--traj', default=False, action='store_true')
+                self.parser.add_argument('--quantize', default=False, action='store_true')
+                # overrides the precision of the policy configuration
+                self.parser.add_argument('--precision', type=str, default=None, choices=['float32', 'bfloat16'])
+                # number of processes running the test cases on the CPU, 1 runs them in this process
+                self.parser.add_argument('--num_workers', type=int, default=1)
+        elif mode == 'serve':
+            self.parser.add_argument('--env_config', type=str, default='configs/env.config')
+            self.parser.add_argument('--policy_config', type=str, default='configs/policy.config')
+            self.parser.add_argument('--policy', type=str, default='sarl')
+            self.parser.add_argument('--model_dir', type=str, default=None)
+            self.parser.add_argument('--il', default=False, action='store_true')
+            self.parser.add_argument('--gpu', default=False, action='store_true')
+            self.parser.add_argument('--socket', type=str, default='/tmp/crowd_nav_policy.sock')
+            self.parser.add_argument('--max_batch_size', type=int, default=256)
+            self.parser.add_argument('--max_wait_time', type=float, default=0.002)
+            # seconds between checks of the model weights file for hot reloading, 0 disables reloading
+            self.parser.add_argument('--reload_interval', type=float, default=1.0)
+        elif mode == 'distill':
+            self.parser.add_argument('--env_config', type=str, default='configs/env.config')
+            self.parser.add_argument('--policy_config', type=str, default='configs/policy.config')
+            self.parser.add_argument('--train_config', type=str, default='configs/train.config')
+            self.parser.add_argument('--policy', type=str, default='sarl')
+            self.parser.add_argument('--model_dir', type=str, required=True)
+            self.parser.add_argument('--gpu', default=False, action='store_true')
+            # the student uses the teacher's policy by default, with the network dimensions of student_config
+            self.parser.add_argument('--student_policy', type=str, default=None)
+            self.parser.add_argument('--student_config', type=str, default='configs/student.config')
+            # budgets of the student network, 0 for no limit
+            self.parser.add_argument('--max_params', type=int, default=0)
+            self.parser.add_argument('--max_flops', type=int, default=0)
+            self.parser.add_argument('--episodes', type=int, default=1000)
+            self.parser.add_argument('--epsilon', type=float, default=0.1)
+            self.parser.add_argument('--capacity', type=int, default=100000)
+            self.parser.add_argument('--epochs', type=int, default=50)
+            self.parser.add_argument('--batch_size', type=int, default=128)
+            self.parser.add_argument('--learning_rate', type=float, default=0.01)
         elif mode == 'plot':
             self.parser.add_argument('log_files', type=str, nargs='+')
             self.parser.add_argument('--plot_sr', default=False, action='store_true')
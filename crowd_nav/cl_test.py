@@ -49,6 +49,12 @@ def main():
         if args.model_dir is None:
             parser.error('Trainable policy must be specified with a model weights directory')
         policy.get_model().load_state_dict(torch.load(model_weights,map_location=device))
+        if args.precision is not None:
+            policy.precision = args.precision
+        if args.quantize:
+            if device.type != 'cpu':
+                parser.error('Quantized inference is only supported on the CPU')
+            policy.quantize()
 
     # configure environment
     env_config = configparser.RawConfigParser()
@@ -82,6 +88,9 @@ def main():
     policy.set_env(env)
     robot.print_info()
     if args.visualize:
+        if hasattr(policy, 'set_attention_capture'):
+            # only copy attention weights to the host when they are rendered
+            policy.set_attention_capture(True)
         ob = env.reset(args.phase, args.test_case)
         done = False
         last_pos = np.array(robot.get_position())
@@ -8,8 +8,10 @@ import gym
 import git
 from crowd_sim.envs.utils.robot import Robot
 from crowd_nav.utils.trainer import Trainer
-from crowd_nav.utils.memory import ReplayMemory
+from crowd_nav.utils.memory import ReplayMemory, PrioritizedReplayMemory
 from crowd_nav.utils.cl_explorer import Explorer
+from crowd_nav.utils.validator import BackgroundValidator
+from crowd_nav.utils.demonstrations import DemonstrationCache, demonstration_key, run_demonstrations
 from crowd_nav.policy.policy_factory import policy_factory
 from crowd_nav.args import Parser
 
@@ -37,6 +39,9 @@ def main():
     log_file = os.path.join(args.output_dir, 'output.log')
     il_weight_file = os.path.join(args.output_dir, 'il_model.pth')
     rl_weight_file = os.path.join(args.output_dir, 'rl_model.pth')
+    # the replay memory is saved with the checkpoints and restored when training is resumed
+    replay_dir = os.path.join(args.output_dir, 'replay')
+    best_val_weight_file = os.path.join(args.output_dir, 'best_val_model.pth')
 
     # configure logging
     mode = 'a' if args.resume else 'w'
@@ -85,6 +90,8 @@ def main():
     epsilon_end = train_config.getfloat('train', 'epsilon_end')
     epsilon_decay = train_config.getfloat('train', 'epsilon_decay')
     checkpoint_interval = train_config.getint('train', 'checkpoint_interval')
+    # validate in a separate process while training continues
+    background_validation = train_config.getboolean('train', 'background_validation', fallback=False)
     # curriculum learning
     env.configure_cl(train_config)
 
@@ -101,10 +108,21 @@ def main():
     # hard_deck_cap = train_config.getint('curriculum','hard_deck_cap')
 
     # configure trainer and explorer
-    memory = ReplayMemory(capacity)
+    # lazy targets store transitions and bootstrap them when they are sampled
+    lazy_targets = train_config.getboolean('trainer', 'lazy_targets', fallback=False)
+    # prioritized replay samples transitions by TD error
+    prioritized_replay = train_config.getboolean('trainer', 'prioritized_replay', fallback=False)
+    priority_beta = train_config.getfloat('trainer', 'priority_beta', fallback=0.4)
+    if prioritized_replay:
+        priority_alpha = train_config.getfloat('trainer', 'priority_alpha', fallback=0.6)
+        memory = PrioritizedReplayMemory(capacity, lazy_targets, priority_alpha, priority_beta)
+    else:
+        memory = ReplayMemory(capacity, lazy_targets)
     model = policy.get_model()
     batch_size = train_config.getint('trainer', 'batch_size')
-    trainer = Trainer(model, memory, device, batch_size)
+    sample_with_replacement = train_config.getboolean('trainer', 'sample_with_replacement', fallback=False)
+    sampler_seed = train_config.getint('trainer', 'sampler_seed', fallback=None)
+    trainer = Trainer(model, memory, device, batch_size, policy.precision, sample_with_replacement, sampler_seed)
     explorer = Explorer(env, robot, device, memory, policy.gamma, target_policy=policy,
                         success_rate_milestone=success_rate_milestone,
                         success_rate_window_size=success_rate_window_size)
@@ -129,19 +147,27 @@ def main():
             safety_space = 0
         else:
             safety_space = train_config.getfloat('imitation_learning', 'safety_space')
+        if args.debug:
+            il_episodes = 1
+        # demonstrations are shared by all runs and policies with the same environment and demonstrating policy
+        demonstration_cache = train_config.get('imitation_learning', 'demonstration_cache', fallback=None)
+        if demonstration_cache:
+            # a relative path is inside the output directory, an absolute one can be shared between runs
+            cache = DemonstrationCache(os.path.join(args.output_dir, demonstration_cache))
+            key = demonstration_key(env_config, il_policy, safety_space, il_episodes, train_config)
+        else:
+            cache, key = None, None
         il_policy = policy_factory[il_policy]()
         il_policy.multiagent_training = policy.multiagent_training
         il_policy.safety_space = safety_space
         robot.set_policy(il_policy)
-        if args.debug:
-            explorer.run_k_episodes(1, 'train', update_memory=True, imitation_learning=True)
-        else:
-            explorer.run_k_episodes(il_episodes, 'train', update_memory=True, imitation_learning=True)
+        run_demonstrations(explorer, il_episodes, cache, key)
         trainer.optimize_epoch(il_epochs)
         torch.save(model.state_dict(), il_weight_file)
         logging.info('Finish imitation learning. Weights saved.')
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
     explorer.update_target_model(model)
+    trainer.set_target_model(explorer.target_model)
 
     # reinforcement learning
     policy.set_env(env)
@@ -155,11 +181,20 @@ def main():
         # save epsilon_end, current episode number and others in a separate file and read everything from there.
         # until its implemented, we assume there is no "resume" option for curriculum learning
         # todo: understand the motivation behind running 100 episodes like this
-        explorer.run_k_episodes(100, 'train', update_memory=True, episode=0)
+        if os.path.exists(replay_dir):
+            memory.load(replay_dir, device)
+            logging.info('Load replay memory from %s', replay_dir)
+        else:
+            explorer.run_k_episodes(100, 'train', update_memory=True, episode=0)
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
     # else: # this else statement is part of the above todo.
 
 
+    if background_validation:
+        validator = BackgroundValidator(args.policy, args.policy_config, args.env_config, args.train_config,
+                                        best_val_weight_file, log_file)
+    else:
+        validator = None
     episode = 0
     last_level_up = 0
     current_level = 0
@@ -175,10 +210,15 @@ def main():
             if epsilon < epsilon_end:
                 epsilon = epsilon_end
         robot.policy.set_epsilon(epsilon)
+        if prioritized_replay:
+            # anneal the importance-sampling correction to full compensation at the end of training
+            memory.beta = priority_beta + (1 - priority_beta) * episode / train_episodes
 
         # evaluate the model
         if episode % evaluation_interval == 0:
-            if not args.debug: # validation takes too long
+            if validator is not None:
+                validator.submit(model, episode)
+            elif not args.debug: # validation takes too long
                 explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode,epsilon=epsilon)
             else:
                 pass
@@ -194,11 +234,13 @@ def main():
 
         if episode % target_update_interval == 0:
             explorer.update_target_model(model)
+            trainer.set_target_model(explorer.target_model)
         if args.debug: # so that we can use the saved model to test visualization
                 torch.save(model.state_dict(), rl_weight_file)
         else:
             if episode != 0 and episode % checkpoint_interval == 0:
                 torch.save(model.state_dict(), rl_weight_file)
+                memory.save(replay_dir)
 
         if level_up:
             if explorer.increase_cl_level():
@@ -207,6 +249,9 @@ def main():
                 level_starts[current_level] = last_level_up
                 logging.info('Level %d starts at episode: %d Epsilon value: %f', current_level, last_level_up,epsilon)
 
+    if validator is not None:
+        validator.close()
+
     # final test
     explorer.run_k_episodes(env.case_size['test'], 'test', episode=episode)
     # log level ups:
@@ -0,0 +1,152 @@
+# Distill a trained value network into a compact student network and compare both on the test cases
+import logging
+import configparser
+import os
+import time
+import torch
+import gym
+from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.state import JointState
+from crowd_sim.envs.utils.info import *
+from crowd_nav.utils.trainer import Trainer
+from crowd_nav.utils.memory import ReplayMemory
+from crowd_nav.utils.explorer import Explorer
+from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.policy.multi_human_rl import MultiHumanRL
+from crowd_nav.args import Parser
+
+
+def count_flops(model):
+    """
+    Multiply-adds of the linear layers for one agent, a rough estimate of the cost of a forward pass
+    """
+    return sum(module.in_features * module.out_features for module in model.modules()
+               if isinstance(module, torch.nn.Linear))
+
+
+def relabel(memory, teacher, batch_size):
+    """
+    Replace the value of every state in the memory by the value the teacher network predicts for it
+    """
+    with torch.no_grad():
+        for start in range(0, len(memory), batch_size):
+            indices = torch.arange(start, min(start + batch_size, len(memory)))
+            states, _, mask = memory.sample(indices)
+            memory.values[indices] = teacher.get_model()(states, mask)
+
+
+def evaluate(policy, env, robot, test_cases):
+    robot.set_policy(policy)
+    policy.set_phase('test')
+    success = 0
+    collision = 0
+    decision_time = 0
+    steps = 0
+    for test_case in test_cases:
+        ob = env.reset('test', test_case)
+        done = False
+        while not done:
+            state = JointState(robot.get_full_state(), ob)
+            start = time.time()
+            action = policy.predict(state)
+            decision_time += time.time() - start
+            steps += 1
+            ob, _, done, info = env.step(action)
+        if isinstance(info, ReachGoal):
+            success += 1
+        elif isinstance(info, Collision):
+            collision += 1
+    return success / len(test_cases), collision / len(test_cases), decision_time / steps
+
+
+def main():
+    parser = Parser(mode='distill')
+    args = parser.parse()
+    env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
+    policy_config_file = os.path.join(args.model_dir, os.path.basename(args.policy_config))
+    train_config_file = os.path.join(args.model_dir, os.path.basename(args.train_config))
+    if os.path.exists(os.path.join(args.model_dir, 'resumed_rl_model.pth')):
+        model_weights = os.path.join(args.model_dir, 'resumed_rl_model.pth')
+    else:
+        model_weights = os.path.join(args.model_dir, 'rl_model.pth')
+    student_policy_name = args.policy if args.student_policy is None else args.student_policy
+    student_config_file = os.path.join(args.model_dir, 'student_policy.config')
+    student_weights = os.path.join(args.model_dir, 'student_model.pth')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
+    logging.info('Using device: %s', device)
+
+    # the teacher is the trained policy, the student is configured by the teacher's configuration overridden by
+    # the compact network dimensions of the student configuration
+    teacher = policy_factory[args.policy]()
+    teacher_config = configparser.RawConfigParser()
+    teacher_config.read(policy_config_file)
+    teacher.configure(teacher_config)
+    teacher.get_model().load_state_dict(torch.load(model_weights, map_location=device))
+    student = policy_factory[student_policy_name]()
+    if not isinstance(teacher, MultiHumanRL) or not isinstance(student, MultiHumanRL):
+        parser.error('Teacher and student have to be policies based on MultiHumanRL')
+    student_config = configparser.RawConfigParser()
+    student_config.read([policy_config_file, args.student_config])
+    student.configure(student_config)
+    if bool(teacher.with_om) != bool(student.with_om):
+        parser.error('Teacher and student have to use the same input, with or without occupancy maps')
+
+    teacher_params = sum(p.numel() for p in teacher.get_model().parameters())
+    student_params = sum(p.numel() for p in student.get_model().parameters())
+    teacher_flops = count_flops(teacher.get_model())
+    student_flops = count_flops(student.get_model())
+    logging.info('Teacher: %d parameters, %d multiply-adds per agent', teacher_params, teacher_flops)
+    logging.info('Student: %d parameters, %d multiply-adds per agent', student_params, student_flops)
+    if args.max_params and student_params > args.max_params:
+        parser.error('Student has {} parameters, more than the budget of {}'.format(student_params, args.max_params))
+    if args.max_flops and student_flops > args.max_flops:
+        parser.error('Student has {} multiply-adds per agent, more than the budget of {}'.format(
+            student_flops, args.max_flops))
+
+    env_config = configparser.RawConfigParser()
+    env_config.read(env_config_file)
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    if os.path.exists(train_config_file):
+        train_config = configparser.RawConfigParser()
+        train_config.read(train_config_file)
+        env.configure_cl(train_config)
+    robot = Robot(env_config, 'robot')
+    env.set_robot(robot)
+    for policy in [teacher, student]:
+        policy.set_device(device)
+        policy.set_env(env)
+        # the environment only sets the time step of the policy the robot is currently using
+        policy.time_step = env.time_step
+
+    # the teacher explores with epsilon-greedy actions so that the student also sees states off the teacher's path
+    memory = ReplayMemory(args.capacity)
+    explorer = Explorer(env, robot, device, memory, teacher.gamma, target_policy=teacher)
+    explorer.update_target_model(teacher.get_model())
+    teacher.set_epsilon(args.epsilon)
+    robot.set_policy(teacher)
+    explorer.run_k_episodes(args.episodes, 'train', update_memory=True, keep_timeouts=True)
+    relabel(memory, teacher, args.batch_size)
+    logging.info('Collected %d states labeled by the teacher', len(memory))
+
+    trainer = Trainer(student.get_model(), memory, device, args.batch_size, student.precision)
+    trainer.set_learning_rate(args.learning_rate)
+    trainer.optimize_epoch(args.epochs)
+    torch.save(student.get_model().state_dict(), student_weights)
+    with open(student_config_file, 'w') as config_file:
+        student_config.write(config_file)
+    logging.info('Student weights saved to %s and its configuration to %s', student_weights, student_config_file)
+
+    test_cases = range(env.case_size['test'])
+    for name, policy, params in [('teacher', teacher, teacher_params), ('student', student, student_params)]:
+        success_rate, collision_rate, avg_decision_time = evaluate(policy, env, robot, test_cases)
+        logging.info('{:<7} ({:>6} parameters) success rate: {:.3f}, collision rate: {:.3f}, '
+                     'time per decision: {:.2f} ms'.format(name, params, success_rate, collision_rate,
+                                                           avg_decision_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import torch
 import numpy as np
 import gym
 from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.evaluator import ParallelEvaluator
 from crowd_nav.policy.policy_factory import policy_factory
 from crowd_sim.envs.utils.robot import Robot
 from crowd_sim.envs.policy.orca import ORCA
@@ -20,6 +21,7 @@ def main():
     if args.model_dir is not None:
         env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
         policy_config_file = os.path.join(args.model_dir, os.path.basename(args.policy_config))
+        train_config_file = os.path.join(args.model_dir, os.path.basename(args.train_config))
         if args.video_file is not None:
             video_file = os.path.join(args.model_dir, os.path.basename(args.video_file))
         if args.il:
@@ -32,6 +34,7 @@ def main():
     else:
         env_config_file = args.env_config
         policy_config_file = args.env_config
+        train_config_file = args.train_config
 
     # configure logging and device
     log_file = os.path.join(args.model_dir, 'general_evaluation.log')
@@ -52,12 +55,25 @@ def main():
         if args.model_dir is None:
             parser.error('Trainable policy must be specified with a model weights directory')
         policy.get_model().load_state_dict(torch.load(model_weights,map_location=device))
+        if args.precision is not None:
+            policy.precision = args.precision
+        if args.quantize:
+            if device.type != 'cpu':
+                parser.error('Quantized inference is only supported on the CPU')
+            policy.quantize()
 
     # configure environment
     env_config = configparser.RawConfigParser()
     env_config.read(env_config_file)
     env = gym.make('CrowdSim-v0')
     env.configure(env_config)
+    # validation and test scenarios use the obstacle radii of the hardest curriculum level
+    if os.path.exists(train_config_file):
+        train_config = configparser.RawConfigParser()
+        train_config.read(train_config_file)
+        env.configure_cl(train_config)
+    else:
+        train_config_file = None
     if args.square:
         env.test_sim = 'square_crossing'
     if args.circle:
@@ -82,6 +98,23 @@ def main():
     policy.set_env(env)
     robot.print_info()
 
+    if args.num_workers > 1:
+        evaluator = ParallelEvaluator(args.num_workers, args.policy, policy_config_file, env_config_file,
+                                      train_config_file, model_weights if policy.trainable else None, args.precision,
+                                      args.quantize)
+    else:
+        evaluator = None
+
+    def evaluate():
+        if evaluator is None:
+            explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        else:
+            # the workers get the numbers of agents of the current setting
+            env_settings = {'test_sim': env.test_sim, 'human_num': env.human_num,
+                            'static_obstacle_num': env.static_obstacle_num}
+            evaluator.run_k_episodes(env.case_size[args.phase], args.phase, env.time_limit, env.time_step,
+                                     print_failure=True, env_settings=env_settings)
+
     n_humans = [0, 5, 10, 15]
     n_obstacles = [0, 5, 10, 15]
 
@@ -96,7 +129,7 @@ def main():
         logging.info("(#humans: {}, #obstacles: {})"
         .format(env.human_num, env.static_obstacle_num)
         )
-        explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        evaluate()
 
     logging.info("General Evaluation: (Fixed #humans)")
     for i, n in enumerate(n_obstacles):
@@ -105,9 +138,10 @@ def main():
         logging.info("(#humans: {}, #obstacles: {})"
         .format(env.human_num, env.static_obstacle_num)
         )
-        explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
+        evaluate()
 
-    
+    if evaluator is not None:
+        evaluator.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+# Script to validate a reduced-precision value network against the float model on the fixed test cases. With bfloat16
+# the check also trains copies of the model for a few batches with and without autocast and compares the success rates
+# of the two trained policies, each evaluated in its own precision.
+import sys
+import logging
+import configparser
+import os
+import time
+import torch
+import gym
+from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.memory import ReplayMemory
+from crowd_nav.utils.trainer import Trainer
+from crowd_sim.envs.utils.robot import Robot
+from crowd_sim.envs.utils.state import JointState
+from crowd_sim.envs.utils.info import *
+from crowd_nav.args import Parser
+
+# maximum drop of the success rate of the reduced-precision policy before the check fails
+SUCCESS_RATE_TOLERANCE = 0.02
+# episodes collected for the training check when the model directory has no saved replay memory
+TRAIN_CHECK_EPISODES = 100
+# seed of the mini-batch sampler, so that both precisions are trained on the same batches
+TRAIN_CHECK_SEED = 0
+
+
+def load_policy(policy_name, policy_config_file, model_weights, device):
+    policy = policy_factory[policy_name]()
+    policy_config = configparser.RawConfigParser()
+    policy_config.read(policy_config_file)
+    policy.configure(policy_config)
+    policy.get_model().load_state_dict(torch.load(model_weights, map_location=device))
+    return policy
+
+
+def run_cases(env, robot, policy, phase, test_cases, reference=None):
+    """
+    Run the test cases with policy and query reference on the same states to compare the chosen actions
+
+    :return: success rate, collision rate, time per decision and the number of same actions and of decisions
+    """
+    robot.set_policy(policy)
+    success = 0
+    collision = 0
+    decision_time = 0
+    steps = 0
+    same_actions = 0
+    for test_case in test_cases:
+        ob = env.reset(phase, test_case)
+        done = False
+        while not done:
+            state = JointState(robot.get_full_state(), ob)
+            start = time.time()
+            action = policy.predict(state)
+            decision_time += time.time() - start
+            steps += 1
+            if reference is not None:
+                same_actions += int(reference.predict(state) == action)
+            ob, _, done, info = env.step(action)
+        if isinstance(info, ReachGoal):
+            success += 1
+        elif isinstance(info, Collision):
+            collision += 1
+    return success / len(test_cases), collision / len(test_cases), decision_time / steps, same_actions, steps
+
+
+def train_copies(policies, env, robot, model_dir, train_config, device):
+    """
+    Train every policy of policies from its current weights for the configured number of batches of a training
+    episode, each with a trainer in the precision of the policy. The memory is the replay memory saved in the model
+    directory, or filled with episodes of the first policy, and all trainers draw the same mini-batches.
+    """
+    capacity = train_config.getint('train', 'capacity')
+    lazy_targets = train_config.getboolean('trainer', 'lazy_targets', fallback=False)
+    batch_size = train_config.getint('trainer', 'batch_size')
+    train_batches = train_config.getint('train', 'train_batches')
+    rl_learning_rate = train_config.getfloat('train', 'rl_learning_rate')
+    memory = ReplayMemory(capacity, lazy_targets)
+    replay_dir = os.path.join(model_dir, 'replay')
+    explorer = Explorer(env, robot, device, memory, policies[0].gamma, target_policy=policies[0])
+    explorer.update_target_model(policies[0].get_model())
+    if os.path.exists(replay_dir):
+        memory.load(replay_dir, device)
+        logging.info('Load replay memory from %s', replay_dir)
+    else:
+        robot.set_policy(policies[0])
+        policies[0].set_epsilon(train_config.getfloat('train', 'epsilon_end'))
+        explorer.run_k_episodes(TRAIN_CHECK_EPISODES, 'train', update_memory=True)
+    for policy in policies:
+        trainer = Trainer(policy.get_model(), memory, device, batch_size, policy.precision, seed=TRAIN_CHECK_SEED)
+        trainer.set_target_model(explorer.target_model)
+        trainer.set_learning_rate(rl_learning_rate)
+        average_loss = trainer.optimize_batch(train_batches)
+        logging.info('Trained the %s model for %d batches, average loss: %.2E', policy.precision, train_batches,
+                     average_loss)
+
+
+def main():
+    parser = Parser(mode='test')
+    args = parser.parse()
+    if args.model_dir is None:
+        parser.error('Model weights directory has to be specified')
+    env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
+    policy_config_file = os.path.join(args.model_dir, os.path.basename(args.policy_config))
+    train_config_file = os.path.join(args.model_dir, os.path.basename(args.train_config))
+    if args.il:
+        model_weights = os.path.join(args.model_dir, 'il_model.pth')
+    elif os.path.exists(os.path.join(args.model_dir, 'resumed_rl_model.pth')):
+        model_weights = os.path.join(args.model_dir, 'resumed_rl_model.pth')
+    else:
+        model_weights = os.path.join(args.model_dir, 'rl_model.pth')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    # quantized models only run on the CPU, bfloat16 is checked on the CPU as well
+    device = torch.device('cpu')
+
+    # the reduced-precision policy is bfloat16 if requested, int8 quantized otherwise
+    reduced = 'bfloat16' if args.precision == 'bfloat16' else 'quantized'
+    float_policy = load_policy(args.policy, policy_config_file, model_weights, device)
+    reduced_policy = load_policy(args.policy, policy_config_file, model_weights, device)
+    if not float_policy.trainable:
+        parser.error('Policy has to be trainable')
+    float_policy.precision = 'float32'
+    if reduced == 'bfloat16':
+        reduced_policy.precision = 'bfloat16'
+    else:
+        reduced_policy.quantize()
+
+    env_config = configparser.RawConfigParser()
+    env_config.read(env_config_file)
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    if os.path.exists(train_config_file):
+        train_config = configparser.RawConfigParser()
+        train_config.read(train_config_file)
+        env.configure_cl(train_config)
+    robot = Robot(env_config, 'robot')
+    env.set_robot(robot)
+    for policy in [float_policy, reduced_policy]:
+        policy.set_phase(args.phase)
+        policy.set_device(device)
+        policy.set_env(env)
+        # the environment only sets the time step of the policy the robot is currently using
+        policy.time_step = env.time_step
+    test_cases = range(env.case_size[args.phase]) if args.test_case is None else [args.test_case]
+
+    # run the float policy and query the reduced-precision policy on the same states to compare the chosen actions
+    results = {}
+    results['float'] = run_cases(env, robot, float_policy, args.phase, test_cases, reference=reduced_policy)
+    results[reduced] = run_cases(env, robot, reduced_policy, args.phase, test_cases)
+    same_actions, decisions = results['float'][3:]
+    checks = [('float', reduced)]
+
+    if reduced == 'bfloat16':
+        # train a copy of the float model with autocast and one without, from the same weights on the same batches,
+        # and evaluate each in the precision it was trained in
+        if not os.path.exists(train_config_file):
+            parser.error('Training check needs the train config in the model directory')
+        trained_policies = []
+        for precision in ['float32', 'bfloat16']:
+            policy = load_policy(args.policy, policy_config_file, model_weights, device)
+            policy.precision = precision
+            policy.set_device(device)
+            policy.set_env(env)
+            policy.time_step = env.time_step
+            trained_policies.append(policy)
+        train_copies(trained_policies, env, robot, args.model_dir, train_config, device)
+        for name, policy in zip(['float-trained', 'bfloat16-trained'], trained_policies):
+            policy.set_phase(args.phase)
+            results[name] = run_cases(env, robot, policy, args.phase, test_cases)
+        checks.append(('float-trained', 'bfloat16-trained'))
+
+    for name, (success_rate, collision_rate, avg_decision_time, _, _) in results.items():
+        logging.info('{:<16} success rate: {:.3f}, collision rate: {:.3f}, time per decision: {:.2f} ms'.format(
+            name, success_rate, collision_rate, avg_decision_time * 1000))
+    logging.info('%s policy chooses the same action as the float policy in %d/%d decisions (%.1f%%)',
+                 reduced.capitalize(), same_actions, decisions, same_actions / decisions * 100)
+    failed = False
+    for baseline, name in checks:
+        if results[name][0] < results[baseline][0] - SUCCESS_RATE_TOLERANCE:
+            logging.error('Success rate of the %s policy dropped by more than %.2f', name, SUCCESS_RATE_TOLERANCE)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
 import numpy as np
 import itertools
 import logging
@@ -19,12 +20,30 @@ def mlp(input_dim, mlp_dims, last_relu=False):
     return net
 
 
+def pad_states(states):
+    """
+    Zero-pad a list of state tensors with different numbers of agents to the largest number of agents
+
+    :param states: list of tensors of shape (# of agents, length of a rotated state)
+    :return: tensor of shape (len(states), max # of agents, length of a rotated state) and a bool validity mask of
+    shape (len(states), max # of agents). The mask is None if no state needed padding.
+    """
+    if states[0].dim() == 1:
+        return torch.stack(states), None
+    lengths = [state.shape[0] for state in states]
+    padded_states = pad_sequence(states, batch_first=True)
+    if min(lengths) == max(lengths):
+        return padded_states, None
+    mask = torch.arange(max(lengths)).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)
+    return padded_states, mask.to(padded_states.device)
+
+
 class ValueNetwork(nn.Module):
     def __init__(self, input_dim, mlp_dims):
         super().__init__()
         self.value_network = mlp(input_dim, mlp_dims)
 
-    def forward(self, state):
+    def forward(self, state, mask=None):
         value = self.value_network(state)
         return value
 
@@ -45,11 +64,20 @@ class CADRL(Policy):
         self.action_space = None
         self.speeds = None
         self.rotations = None
+        # action space as a tensor of shape (# actions, 2), (vx, vy) for holonomic and (v, r) for unicycle kinematics
+        self.action_velocities = None
+        self.rotation_cos = None
+        self.rotation_sin = None
         self.action_values = None
         self.with_om = None
         self.cell_num = None
         self.cell_size = None
         self.om_channel_size = None
+        self.max_agents = None
+        self.sensing_radius = None
+        # shared inference batcher that evaluates the value network, None to call the model directly
+        self.batcher = None
+        self.precision = None
         self.self_state_dim = 6
         self.human_state_dim = 7
         self.joint_state_dim = self.self_state_dim + self.human_state_dim
@@ -71,14 +99,47 @@ class CADRL(Policy):
         self.cell_num = config.getint('om', 'cell_num')
         self.cell_size = config.getfloat('om', 'cell_size')
         self.om_channel_size = config.getint('om', 'om_channel_size')
+        self.max_agents = config.getint('input', 'max_agents', fallback=0)
+        self.sensing_radius = config.getfloat('input', 'sensing_radius', fallback=0)
+        self.precision = config.get('rl', 'precision', fallback='float32')
+        if self.precision not in ['float32', 'bfloat16']:
+            raise ValueError('Unknown precision: {}'.format(self.precision))
 
     def set_device(self, device):
         self.device = device
         self.model.to(device)
+        if self.action_velocities is not None:
+            self.action_velocities = self.action_velocities.to(device)
+            self.rotation_cos = self.rotation_cos.to(device)
+            self.rotation_sin = self.rotation_sin.to(device)
 
     def set_epsilon(self, epsilon):
         self.epsilon = epsilon
 
+    def set_batcher(self, batcher):
+        self.batcher = batcher
+
+    def evaluate_batch(self, states, mask=None):
+        """
+        Evaluate a batch of rotated states with the value network, through the inference batcher if one is set
+        """
+        if self.batcher is not None:
+            return self.batcher.evaluate(states, mask)
+        # the weights stay in float32, autocast runs the matrix multiplications in bfloat16
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bfloat16'):
+            values = self.model(states, mask)
+        return values.float()
+
+    def quantize(self):
+        """
+        Replace the linear layers of the value network by dynamically quantized int8 layers for CPU inference.
+        The quantized model can't be trained and has to stay on the CPU.
+        """
+        self.model = torch.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        # quantized layers compute in int8 regardless of the precision setting
+        self.precision = 'float32'
+        logging.info('Value network is quantized to int8')
+
     def build_action_space(self, v_pref):
         """
         Action space consists of 25 uniformly sampled actions in permitted range and 25 randomly sampled actions.
@@ -100,13 +161,18 @@ class CADRL(Policy):
         self.speeds = speeds
         self.rotations = rotations
         self.action_space = action_space
+        # double precision keeps propagate_batch() consistent with the python floats used in propagate()
+        self.action_velocities = torch.tensor([tuple(action) for action in action_space], dtype=torch.float64,
+                                              device=self.device)
+        self.rotation_cos = torch.cos(self.action_velocities[:, 1])
+        self.rotation_sin = torch.sin(self.action_velocities[:, 1])
 
     def propagate(self, state, action):
         if isinstance(state, ObservableState):
             # propagate state of humans
             next_px = state.px + action.vx * self.time_step
             next_py = state.py + action.vy * self.time_step
-            next_state = ObservableState(next_px, next_py, action.vx, action.vy, state.radius)
+            next_state = ObservableState(next_px, next_py, action.vx, action.vy, state.radius, state.uncertainty)
         elif isinstance(state, FullState):
             # propagate state of current agent
             # perform action without rotation
@@ -128,6 +194,32 @@ class CADRL(Policy):
 
         return next_state
 
+    def propagate_batch(self, state):
+        """
+        Propagate the full state of the current agent with every action of the action space at once
+
+        :param state: FullState of the current agent
+        :return: tensor of shape (# actions, 9) with the next full states in the order of FullState's fields
+        """
+        num_actions = self.action_velocities.shape[0]
+        if self.kinematics == 'holonomic':
+            next_velocities = self.action_velocities
+            next_theta = torch.full((num_actions,), state.theta, dtype=torch.float64, device=self.device)
+        else:
+            # cos(theta + r) and sin(theta + r) are expanded with the cached cos/sin tables of the rotations
+            speeds = self.action_velocities[:, 0]
+            cos_theta = np.cos(state.theta)
+            sin_theta = np.sin(state.theta)
+            next_velocities = torch.stack([speeds * (cos_theta * self.rotation_cos - sin_theta * self.rotation_sin),
+                                           speeds * (sin_theta * self.rotation_cos + cos_theta * self.rotation_sin)],
+                                          dim=1)
+            next_theta = state.theta + self.action_velocities[:, 1]
+        next_positions = torch.tensor(state.position, dtype=torch.float64, device=self.device) + \
+            next_velocities * self.time_step
+        static_attributes = torch.tensor([state.radius, state.gx, state.gy, state.v_pref], dtype=torch.float64,
+                                         device=self.device).expand(num_actions, -1)
+        return torch.cat([next_positions, next_velocities, static_attributes, next_theta.unsqueeze(1)], dim=1)
+
     def predict(self, state):
         """
         Input state is the joint state of robot concatenated by the observable state of other agents
@@ -164,7 +256,7 @@ class CADRL(Policy):
                 batch_next_states = torch.cat([torch.Tensor([next_self_state + next_human_state]).to(self.device)
                                               for next_human_state in ob], dim=0)
                 # VALUE UPDATE
-                outputs = self.model(self.rotate(batch_next_states))
+                outputs = self.evaluate_batch(self.rotate(batch_next_states))
                 min_output, min_index = torch.min(outputs, 0)
                 min_value = reward + pow(self.gamma, self.time_step * state.self_state.v_pref) * min_output.data.item()
                 self.action_values.append(min_value)
@@ -20,16 +20,19 @@ class GraphAttentionLayerForSingleNode(nn.Module):
         nn.init.xavier_uniform_(self.W.data, gain = 1.414)
         self.a = nn.Parameter(torch.empty(size = (2 * out_dim, 1)))
         nn.init.xavier_uniform_(self.a.data, gain = 1.414)
+        # attention weights are only copied to the host when capture is enabled, e.g. for rendering
+        self.capture_attention = False
         self.attention_weights = None
         self.leakyrelu = nn.LeakyReLU(self.alpha)
 
-    def forward(self, h):
+    def forward(self, h, mask=None):
         '''
         Dimension of h = B x N x D
         B = batch_size
         N = 1 (robot itself) + num_humans + num_obstacles
         D = in_dim
         O = out_dim
+        Dimension of mask = B x (N - 1), False for padded agents, None if there is no padding
         '''
         B, N, D = h.shape
         Wh = torch.mm(h.view(B * N, -1), self.W) ## Wh.shape = (B, N, O)
@@ -44,8 +47,11 @@ class GraphAttentionLayerForSingleNode(nn.Module):
         attention = torch.mm(cat1.view(B * (N - 1), -1), self.a).squeeze()
         attention = attention.view(B, N - 1)
         # assert attention.shape == (B, N - 1)
+        if mask is not None:
+            attention = attention.masked_fill(~mask, float('-inf'))
         attention = F.softmax(attention, dim = 1)
-        self.attention_weights = attention.squeeze().data.cpu().numpy()
+        if self.capture_attention:
+            self.attention_weights = attention[0].data.cpu().numpy()
         h_prime = attention.unsqueeze(-1) * other_agent_states
         # assert h_prime.shape == (B, N - 1, self.out_dim)
 
@@ -55,19 +61,78 @@ class GraphAttentionLayerForSingleNode(nn.Module):
         else:
             return h_prime_cat
 
+class MultiHeadGraphAttentionLayerForSingleNode(nn.Module):
+    def __init__(self, in_dim, out_dim, num_heads, alpha, concat = True):
+        super(MultiHeadGraphAttentionLayerForSingleNode, self).__init__()
+        self.in_dim = in_dim
+        self.out_dim = out_dim
+        self.num_heads = num_heads
+        self.alpha = alpha
+        self.concat = concat
+
+        # weights of all heads are stacked so that they are applied in a single batched matmul
+        self.W = nn.Parameter(torch.empty(size = (num_heads, in_dim, out_dim)))
+        self.a = nn.Parameter(torch.empty(size = (num_heads, 2 * out_dim, 1)))
+        for i in range(num_heads):
+            nn.init.xavier_uniform_(self.W.data[i], gain = 1.414)
+            nn.init.xavier_uniform_(self.a.data[i], gain = 1.414)
+        self.leakyrelu = nn.LeakyReLU(self.alpha)
+
+    def forward(self, h, mask=None):
+        '''
+        Dimension of h = B x N x D
+        Dimension of mask = B x (N - 1), False for padded agents, None if there is no padding
+        H = num_heads
+        Output dimension = B x N x (H * O), heads are concatenated in the feature dimension
+        '''
+        B, N, D = h.shape
+        Wh = torch.matmul(h.unsqueeze(1), self.W) ## Wh.shape = (B, H, N, O)
+        robot_state = Wh[:, :, :1, :]
+        other_agent_states = Wh[:, :, 1:, :]
+        # a^T [Wh_robot || Wh_other] = a_robot^T Wh_robot + a_other^T Wh_other
+        robot_score = torch.matmul(robot_state, self.a[:, :self.out_dim, :])
+        other_score = torch.matmul(other_agent_states, self.a[:, self.out_dim:, :])
+        attention = (robot_score + other_score).squeeze(-1)
+        # assert attention.shape == (B, H, N - 1)
+        if mask is not None:
+            attention = attention.masked_fill(~mask.unsqueeze(1), float('-inf'))
+        attention = F.softmax(attention, dim = -1)
+        h_prime = attention.unsqueeze(-1) * other_agent_states
+
+        h_prime_cat = torch.cat((robot_state, h_prime), dim = 2)
+        h_prime_cat = h_prime_cat.permute(0, 2, 1, 3).reshape(B, N, -1)
+        if self.concat:
+            return F.elu(h_prime_cat)
+        else:
+            return h_prime_cat
+
 class GAT(nn.Module):
     def __init__(self, num_feat, num_hidden_feat, num_out_feat, alpha, nheads):
         super(GAT, self).__init__()
 
-        self.attentions = [GraphAttentionLayerForSingleNode(num_feat, num_hidden_feat, alpha=alpha, concat=True) for _ in range(nheads)]
-        for i, attention in enumerate(self.attentions):
-            self.add_module('attention_{}'.format(i), attention)
-
+        self.attentions = MultiHeadGraphAttentionLayerForSingleNode(num_feat, num_hidden_feat, nheads, alpha=alpha,
+                                                                    concat=True)
         self.out_att = GraphAttentionLayerForSingleNode(num_hidden_feat * nheads, num_out_feat, alpha=alpha, concat=False)
+        self._register_load_state_dict_pre_hook(self._stack_attention_heads)
 
-    def forward(self, x):
-        x = torch.cat([att(x) for att in self.attentions], dim = -1)
-        x = F.elu(self.out_att(x))
+    @staticmethod
+    def _stack_attention_heads(state_dict, prefix, *args):
+        '''
+        Convert checkpoints saved with one GraphAttentionLayerForSingleNode per head
+        (attention_0.W, attention_1.W, ...) to the stacked weights of the fused layer
+        '''
+        for name in ['W', 'a']:
+            head = 0
+            heads = []
+            while '{}attention_{}.{}'.format(prefix, head, name) in state_dict:
+                heads.append(state_dict.pop('{}attention_{}.{}'.format(prefix, head, name)))
+                head += 1
+            if heads:
+                state_dict['{}attentions.{}'.format(prefix, name)] = torch.stack(heads)
+
+    def forward(self, x, mask=None):
+        x = self.attentions(x, mask)
+        x = F.elu(self.out_att(x, mask))
         return x
 
 class ValueNetwork(nn.Module):
@@ -83,12 +148,13 @@ class ValueNetwork(nn.Module):
         self.gat = GAT(mlp1_dims[-1], num_hidden_feat, num_out_feat, alpha, num_heads)
 
 
-    def forward(self, state):
+    def forward(self, state, mask=None):
         '''
         Dimension of state = B x N x D
         B = batch_size
         N = num_humans + num_obstacles
         D = robot_state_dim + other_agent_states_dim
+        Dimension of mask = B x N, False for padded agents, None if there is no padding
         '''
         B, N, D = state.shape
 
@@ -103,10 +169,12 @@ class ValueNetwork(nn.Module):
 
         embed_cat = torch.cat((robot_state_embed.view(B, 1, -1), other_agent_states_embed), dim = 1)
 
-        gat_embed = self.gat(embed_cat)
+        gat_embed = self.gat(embed_cat, mask)
 
         robot_gat_embed = gat_embed[:, 0, :]
         other_agent_gat_embeds = gat_embed[:, 1:, :]
+        if mask is not None:
+            other_agent_gat_embeds = other_agent_gat_embeds * mask.unsqueeze(-1)
         other_agent_gat_embeds = other_agent_gat_embeds.sum(dim = 1)
 
         cat_embed = torch.cat((robot_gat_embed, other_agent_gat_embeds), dim = -1)
@@ -120,6 +188,7 @@ class GAT4SN(MultiHumanRL):
     def __init__(self):
         super().__init__()
         self.name = 'GAT4SN'
+        self.capture_attention = False
 
     def configure(self, config):
         self.set_common_parameters(config)
@@ -137,5 +206,10 @@ class GAT4SN(MultiHumanRL):
         logging.info('Policy: {} with {} attention heads'.format(self.name, num_heads))
         logging.info('Number of parameters: {}'.format(self.num_total_params))
 
+    def set_attention_capture(self, capture):
+        self.capture_attention = capture
+        self.model.gat.out_att.capture_attention = capture
+        self.model.gat.out_att.attention_weights = None
+
     def get_attention_weights(self):
-        return self.model.gat.out_att.attention_weights
+        return self.expand_attention_weights(self.model.gat.out_att.attention_weights)
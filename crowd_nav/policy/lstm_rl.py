@@ -1,64 +1,100 @@
 import torch
 import torch.nn as nn
-import numpy as np
+from torch.nn.utils.rnn import pack_padded_sequence
 import logging
 from crowd_nav.policy.cadrl import mlp
 from crowd_nav.policy.multi_human_rl import MultiHumanRL
 
 
-class ValueNetwork1(nn.Module):
-    def __init__(self, input_dim, self_state_dim, mlp_dims, lstm_hidden_dim):
+def sort_by_distance(state, mask, self_state_dim):
+    """
+    Sort humans by decreasing distance to the robot so that the closest human is the last input of the lstm.
+    Padded humans are moved to the end of the sequences.
+
+    :param state: tensor of shape (batch_size, # of humans, length of a rotated state)
+    """
+    # the distance between robot and human (da) is the 6th feature of the rotated human state
+    dist = state[:, :, self_state_dim + 5]
+    if mask is not None:
+        dist = dist.masked_fill(~mask, float('-inf'))
+    order = torch.argsort(dist, dim=1, descending=True)
+    return torch.gather(state, 1, order.unsqueeze(2).expand(-1, -1, state.shape[2]))
+
+
+def pack_states(state, mask):
+    """
+    Pack padded sequences so that the final hidden state of the lstm is taken at the last valid human
+    """
+    if mask is None:
+        return state
+    lengths = torch.sum(mask, dim=1).cpu()
+    return pack_padded_sequence(state, lengths, batch_first=True, enforce_sorted=False)
+
+
+class LstmValueNetwork(nn.Module):
+    def __init__(self, self_state_dim, lstm_hidden_dim):
         super().__init__()
         self.self_state_dim = self_state_dim
         self.lstm_hidden_dim = lstm_hidden_dim
+        # zero initial states of the lstm, kept on the device of the model and grown to the largest batch size
+        self.register_buffer('zero_state', torch.zeros(1, 1, lstm_hidden_dim), persistent=False)
+
+    def initial_state(self, batch_size):
+        if self.zero_state.shape[1] < batch_size:
+            self.zero_state = self.zero_state.new_zeros(1, batch_size, self.lstm_hidden_dim)
+        h0 = self.zero_state[:, :batch_size]
+        return h0, h0
+
+
+class ValueNetwork1(LstmValueNetwork):
+    def __init__(self, input_dim, self_state_dim, mlp_dims, lstm_hidden_dim):
+        super().__init__(self_state_dim, lstm_hidden_dim)
         self.mlp = mlp(self_state_dim + lstm_hidden_dim, mlp_dims)
         self.lstm = nn.LSTM(input_dim, lstm_hidden_dim, batch_first=True)
 
-    def forward(self, state):
+    def forward(self, state, mask=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a joint state)
+        :param mask: bool tensor of shape (batch_size, # of humans), False for padded humans. None if no padding
         :return:
         """
         size = state.shape
         self_state = state[:, 0, :self.self_state_dim]
+        state = sort_by_distance(state, mask, self.self_state_dim)
         # human_state = state[:, :, self.self_state_dim:]
-        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        output, (hn, cn) = self.lstm(state, (h0, c0))
+        output, (hn, cn) = self.lstm(pack_states(state, mask), self.initial_state(size[0]))
         hn = hn.squeeze(0)
         joint_state = torch.cat([self_state, hn], dim=1)
         value = self.mlp(joint_state)
         return value
 
 
-class ValueNetwork2(nn.Module):
+class ValueNetwork2(LstmValueNetwork):
     def __init__(self, input_dim, self_state_dim, mlp1_dims, mlp_dims, lstm_hidden_dim):
-        super().__init__()
-        self.self_state_dim = self_state_dim
-        self.lstm_hidden_dim = lstm_hidden_dim
+        super().__init__(self_state_dim, lstm_hidden_dim)
         self.mlp1 = mlp(input_dim, mlp1_dims)
         self.mlp = mlp(self_state_dim + lstm_hidden_dim, mlp_dims)
         self.lstm = nn.LSTM(mlp1_dims[-1], lstm_hidden_dim, batch_first=True)
 
-    def forward(self, state):
+    def forward(self, state, mask=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a joint state)
+        :param mask: bool tensor of shape (batch_size, # of humans), False for padded humans. None if no padding
         :return:
         """
         size = state.shape
         self_state = state[:, 0, :self.self_state_dim]
+        state = sort_by_distance(state, mask, self.self_state_dim)
 
         state = torch.reshape(state, (-1, size[2]))
         mlp1_output = self.mlp1(state)
         mlp1_output = torch.reshape(mlp1_output, (size[0], size[1], -1))
 
-        h0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        c0 = torch.zeros(1, size[0], self.lstm_hidden_dim)
-        output, (hn, cn) = self.lstm(mlp1_output, (h0, c0))
+        output, (hn, cn) = self.lstm(pack_states(mlp1_output, mask), self.initial_state(size[0]))
         hn = hn.squeeze(0)
         joint_state = torch.cat([self_state, hn], dim=1)
         value = self.mlp(joint_state)
@@ -86,20 +122,3 @@ class LstmRL(MultiHumanRL):
         self.multiagent_training = config.getboolean('lstm_rl', 'multiagent_training')
         logging.info('Policy: {}LSTM-RL {} pairwise interaction module'.format(
             'OM-' if self.with_om else '', 'w/' if with_interaction_module else 'w/o'))
-
-    def predict(self, state):
-        """
-        Input state is the joint state of robot concatenated with the observable state of other agents
-
-        To predict the best action, agent samples actions and propagates one step to see how good the next state is
-        thus the reward function is needed
-
-        """
-
-        def dist(human):
-            # sort human order by decreasing distance to the robot
-            return np.linalg.norm(np.array(human.position) - np.array(state.self_state.position))
-
-        state.human_states = sorted(state.human_states, key=dist, reverse=True)
-        return super().predict(state)
-
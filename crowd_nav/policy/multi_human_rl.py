@@ -1,12 +1,59 @@
+import logging
+import time
 import torch
 import numpy as np
 from crowd_sim.envs.utils.action import ActionRot, ActionXY
-from crowd_nav.policy.cadrl import CADRL
+from crowd_sim.envs.utils.info import Collision
+from crowd_nav.policy.cadrl import CADRL, pad_states
+from crowd_nav.policy.planner import Planner
 
 
 class MultiHumanRL(CADRL):
     def __init__(self):
         super().__init__()
+        # agents selected in the last prediction, used to map attention weights back to all agents
+        self.agent_indices = None
+        self.agent_num = None
+        self.planner = None
+        self.decision_budget = None
+        self.chunk_size = None
+        # number of actions evaluated in the last decision
+        self.evaluated_actions = None
+        # rewards of the lookahead without the simulator, the same as the environment's once it is set
+        self.success_reward = 1
+        self.collision_penalty = -0.25
+        self.out_boundary_penalty = -0.25
+        self.discomfort_dist = 0.2
+        self.discomfort_penalty_factor = 0.5
+        # width of the square area around the origin the robot has to stay in, not checked if None
+        self.boundary = None
+
+    def set_common_parameters(self, config):
+        super().set_common_parameters(config)
+        depth = config.getint('planner', 'depth', fallback=1)
+        if depth > 1:
+            self.planner = Planner(self, depth, config.getint('planner', 'beam_width', fallback=4),
+                                   config.getfloat('planner', 'time_budget', fallback=0))
+            logging.info('Action selection: depth {} tree search with beam width {}'.format(
+                depth, self.planner.beam_width))
+        self.decision_budget = config.getfloat('anytime', 'decision_budget', fallback=0)
+        self.chunk_size = config.getint('anytime', 'chunk_size', fallback=8)
+
+    def set_env(self, env):
+        super().set_env(env)
+        self.configure_rewards(env.config)
+
+    def configure_rewards(self, env_config):
+        """
+        Read the rewards and the boundary of the environment, so that the lookahead without the simulator rewards and
+        prunes the actions like the environment does
+        """
+        self.success_reward = env_config.getfloat('reward', 'success_reward')
+        self.collision_penalty = env_config.getfloat('reward', 'collision_penalty')
+        self.out_boundary_penalty = env_config.getfloat('reward', 'out_boundary_penalty')
+        self.discomfort_dist = env_config.getfloat('reward', 'discomfort_dist')
+        self.discomfort_penalty_factor = env_config.getfloat('reward', 'discomfort_penalty_factor')
+        self.boundary = env_config.getfloat('sim', 'boundary')
 
     def predict(self, state):
         """
@@ -24,7 +71,7 @@ class MultiHumanRL(CADRL):
         if self.action_space is None:
             self.build_action_space(state.self_state.v_pref)
 
-        occupancy_maps = None
+        agent_indices = self.select_agents(state)
         probability = np.random.random()
         if self.phase == 'train' and probability < self.epsilon:
             max_action = self.action_space[np.random.choice(len(self.action_space))]
@@ -32,32 +79,20 @@ class MultiHumanRL(CADRL):
             self.action_values = list()
             max_value = float('-inf')
             max_action = None
-            for action in self.action_space:
-                next_self_state = self.propagate(state.self_state, action)
-                if self.query_env:
-                    next_human_states, reward, done, info = self.env.onestep_lookahead(action)
-                else:
-                    next_human_states = [self.propagate(human_state, ActionXY(human_state.vx, human_state.vy))
-                                       for human_state in state.human_states]
-                    reward = self.compute_reward(next_self_state, next_human_states)
-                batch_next_states = torch.cat([torch.Tensor([next_self_state + next_human_state]).to(self.device)
-                                              for next_human_state in next_human_states], dim=0)
-                rotated_batch_input = self.rotate(batch_next_states).unsqueeze(0)
-                if self.with_om:
-                    if occupancy_maps is None:
-                        occupancy_maps = self.build_occupancy_maps(next_human_states).unsqueeze(0)
-                    rotated_batch_input = torch.cat([rotated_batch_input, occupancy_maps.to(self.device)], dim=2)
-                # VALUE UPDATE
-                next_state_value = self.model(rotated_batch_input).data.item()
-                value = reward + pow(self.gamma, self.time_step * state.self_state.v_pref) * next_state_value
+            self.agent_indices = agent_indices
+            self.agent_num = len(state.human_states)
+            if self.planner is not None:
+                values = self.planner.plan(state, agent_indices)
+            else:
+                values = self.evaluate_actions(state, agent_indices)
+            for action, value in zip(self.action_space, values.tolist()):
                 self.action_values.append(value)
                 if value > max_value:
                     max_value = value
                     max_action = action
             if max_action is None:
-                # original implemetation: todo: fix!!
-                # raise ValueError('Value network is not well trained. ')
-                print("max action is none!! falling back to random action!!")
+                # all values are nan
+                logging.warning('Value network gives no valid action value, falling back to a random action')
                 max_action = self.action_space[np.random.choice(len(self.action_space))]
 
         if self.phase == 'train':
@@ -65,47 +100,222 @@ class MultiHumanRL(CADRL):
 
         return max_action
 
-    def compute_reward(self, nav, humans):
-        # collision detection
-        dmin = float('inf')
-        collision = False
-        for i, human in enumerate(humans):
-            dist = np.linalg.norm((nav.px - human.px, nav.py - human.py)) - nav.radius - human.radius
-            if dist < 0:
-                collision = True
+    def evaluate_actions(self, state, agent_indices):
+        """
+        One-step lookahead: the value of an action is its reward plus the discounted value of the next state.
+        With a decision budget, actions are evaluated in chunks in goal-directed order until the budget expires,
+        the first chunk is always evaluated and the remaining actions get value -inf.
+
+        :param state: joint state of the robot and the humans
+        :param agent_indices: indices of the humans passed to the value network, None for all humans
+        :return: values of all actions in the action space
+        """
+        start = time.time()
+        next_self_states = self.propagate_batch(state.self_state)
+        num_actions = len(self.action_space)
+        if not self.decision_budget:
+            self.evaluated_actions = num_actions
+            return self.lookahead(state, agent_indices, next_self_states, np.arange(num_actions))
+
+        # actions that bring the robot closest to its goal first
+        goal_distances = torch.norm(next_self_states[:, :2] - next_self_states[:, 5:7], dim=1).cpu().numpy()
+        order = np.argsort(goal_distances, kind='stable')
+        values = np.full(num_actions, float('-inf'))
+        self.evaluated_actions = 0
+        while self.evaluated_actions < num_actions:
+            actions = order[self.evaluated_actions:self.evaluated_actions + self.chunk_size]
+            values[actions] = self.lookahead(state, agent_indices, next_self_states[torch.from_numpy(actions)],
+                                             actions)
+            self.evaluated_actions += len(actions)
+            if time.time() - start > self.decision_budget:
                 break
-            if dist < dmin:
-                dmin = dist
+        logging.debug('Evaluated {}/{} actions in {:.2f} ms'.format(self.evaluated_actions, num_actions,
+                                                                    (time.time() - start) * 1000))
+        return values
 
-        # check if reaching the goal
-        reaching_goal = np.linalg.norm((nav.px - nav.gx, nav.py - nav.gy)) < nav.radius
-        if collision:
-            reward = -0.25
-        elif reaching_goal:
-            reward = 1
-        elif dmin < 0.2:
-            reward = (dmin - 0.2) * 0.5 * self.time_step
+    def lookahead(self, state, agent_indices, next_self_states, actions):
+        """
+        :param next_self_states: tensor of shape (len(actions), self state length) from propagate_batch
+        :param actions: indices of the evaluated actions in the action space
+        :return: values of the evaluated actions
+        """
+        occupancy_maps = None
+        if self.query_env:
+            rewards = []
+            collisions = []
+            batch_human_states = []
+            for action in actions:
+                next_human_states, reward, done, info = self.env.onestep_lookahead(self.action_space[action])
+                collisions.append(done and isinstance(info, Collision))
+                if agent_indices is not None:
+                    next_human_states = [next_human_states[i] for i in agent_indices]
+                if self.with_om and occupancy_maps is None:
+                    occupancy_maps = self.build_occupancy_maps(next_human_states).to(self.device)
+                batch_human_states.append(self.human_states_to_tensor(next_human_states))
+                rewards.append(reward)
+            rewards = np.array(rewards)
+            collisions = np.array(collisions)
+        else:
+            # without the simulator humans are assumed to keep their velocity, which doesn't depend on the action
+            human_states = self.selected_agents(state, agent_indices)
+            next_human_states = self.propagate_humans(self.human_states_to_tensor(human_states))
+            rewards, collisions = self.compute_rewards(next_self_states, next_human_states)
+            if self.with_om:
+                occupancy_maps = self.build_occupancy_maps(
+                    [self.propagate(human_state, ActionXY(human_state.vx, human_state.vy))
+                     for human_state in human_states]).to(self.device)
+            batch_human_states = [next_human_states] * len(actions)
+
+        # VALUE UPDATE
+        # actions ending in a collision are terminal and valued by their reward alone, the next states of
+        # the remaining actions are evaluated in one forward pass, padded to the largest # of humans
+        evaluated = np.flatnonzero(~collisions)
+        if evaluated.size == 0:
+            # every action collides, rank them by the value network instead of picking one arbitrarily
+            evaluated = np.arange(len(actions))
+        batch_input, mask = self.build_action_batch(next_self_states[torch.from_numpy(evaluated)],
+                                                    [batch_human_states[i] for i in evaluated], occupancy_maps)
+        next_state_values = self.evaluate_batch(batch_input, mask).squeeze(1).data.cpu().numpy()
+        values = rewards.astype(np.float64)
+        values[evaluated] += pow(self.gamma, self.time_step * state.self_state.v_pref) * next_state_values
+        return values
+
+    def human_states_to_tensor(self, human_states):
+        """
+        :return: tensor of shape (# of humans, human state length) in the order of ObservableState's fields
+        """
+        # ObservableState + tuple appends the state's fields to the tuple
+        return torch.tensor([human_state + () for human_state in human_states], dtype=torch.float32, device=self.device)
+
+    def build_action_batch(self, next_self_states, next_human_states, occupancy_maps=None):
+        """
+        Pair the next self state of every action with the next human states of the same action
+
+        :param next_self_states: tensor of shape (# actions, self state length) from propagate_batch
+        :param next_human_states: list of tensors of shape (# of humans, human state length), one for each action
+        :param occupancy_maps: tensor of shape (# of humans, occupancy map length) shared by all actions
+        :return: rotated batch of shape (# actions, max # of humans, input_dim) and its mask (None if not padded)
+        """
+        human_states, mask = pad_states(next_human_states)
+        num_actions, human_num, _ = human_states.shape
+        joint_states = torch.cat([next_self_states.to(human_states.dtype).unsqueeze(1).expand(-1, human_num, -1),
+                                  human_states], dim=2)
+        batch = self.rotate(joint_states.view(num_actions * human_num, -1)).view(num_actions, human_num, -1)
+        if occupancy_maps is not None:
+            batch = torch.cat([batch, occupancy_maps.unsqueeze(0).expand(num_actions, -1, -1)], dim=2)
+        return batch, mask
+
+    def propagate_humans(self, human_states):
+        """
+        Propagate all humans one step with their current velocities
+
+        :param human_states: tensor of shape (# of humans, human state length) from human_states_to_tensor
+        :return: tensor of the same shape with the next human states
+        """
+        next_human_states = human_states.clone()
+        next_human_states[:, :2] += human_states[:, 2:4] * self.time_step
+        return next_human_states
+
+    def compute_rewards(self, next_self_states, next_human_states):
+        """
+        Compute the rewards of all actions at once with broadcasting
+
+        :param next_self_states: tensor of shape (# actions, self state length) from propagate_batch
+        :param next_human_states: tensor of shape (# of humans, human state length), shared by all actions
+        :return: arrays of shape (# actions,) with the rewards and whether each action ends in a collision, which
+            includes leaving the boundary
+        """
+        humans = next_human_states.to(next_self_states.dtype)
+        positions = next_self_states[:, :2]
+        radius = next_self_states[:, 4]
+        # collision detection
+        if humans.shape[0] > 0:
+            dist = torch.norm(positions.unsqueeze(1) - humans[:, :2].unsqueeze(0), dim=2) - radius.unsqueeze(1) - \
+                humans[:, 4].unsqueeze(0)
+            dmin = torch.min(dist, dim=1)[0]
+        else:
+            dmin = torch.full_like(radius, float('inf'))
+        collision = dmin < 0
+
+        # check if the robot runs out of the boundary, the distance to the boundary counts as discomfort as well
+        if self.boundary is not None:
+            dist_to_boundary = self.boundary / 2 - (torch.abs(positions) + radius.unsqueeze(1))
+            out = torch.any(dist_to_boundary < 0, dim=1)
+            dmin = torch.min(dmin, torch.min(dist_to_boundary, dim=1)[0])
         else:
-            reward = 0
+            out = torch.zeros_like(collision)
 
-        return reward
+        # check if reaching the goal
+        reaching_goal = torch.norm(positions - next_self_states[:, 5:7], dim=1) < radius
+        rewards = torch.where(dmin < self.discomfort_dist,
+                              (dmin - self.discomfort_dist) * self.discomfort_penalty_factor * self.time_step,
+                              torch.zeros_like(dmin))
+        rewards = torch.where(reaching_goal, torch.full_like(rewards, self.success_reward), rewards)
+        rewards = torch.where(collision, torch.full_like(rewards, self.collision_penalty), rewards)
+        rewards = torch.where(out, torch.full_like(rewards, self.out_boundary_penalty), rewards)
+
+        return rewards.cpu().numpy(), (collision | out).cpu().numpy()
 
     def transform(self, state):
         """
         Take the state passed from agent and transform it to the input of value network
 
         :param state:
-        :return: tensor of shape (# of humans, len(state))
+        :return: tensor of shape (# of selected humans, len(state))
         """
+        human_states = self.selected_agents(state, self.select_agents(state))
         state_tensor = torch.cat([torch.Tensor([state.self_state + human_state]).to(self.device)
-                                  for human_state in state.human_states], dim=0)
+                                  for human_state in human_states], dim=0)
         if self.with_om:
-            occupancy_maps = self.build_occupancy_maps(state.human_states)
+            occupancy_maps = self.build_occupancy_maps(human_states)
             state_tensor = torch.cat([self.rotate(state_tensor), occupancy_maps.to(self.device)], dim=1)
         else:
             state_tensor = self.rotate(state_tensor)
         return state_tensor
 
+    def select_agents(self, state):
+        """
+        Select the max_agents nearest agents that are within the sensing radius of the robot, so that the input size
+        of the value network is bounded regardless of the crowd size. The nearest agent is always kept.
+        Distances are measured between the boundaries of the robot and the agents.
+
+        :param state:
+        :return: sorted indices of the selected agents in state.human_states, None if all agents are selected
+        """
+        agent_num = len(state.human_states)
+        if not self.max_agents and not self.sensing_radius or agent_num == 0:
+            return None
+        self_state = state.self_state
+        agents = np.array([(human_state.px, human_state.py, human_state.radius) for human_state in state.human_states])
+        dist = np.linalg.norm(agents[:, :2] - np.array(self_state.position), axis=1) - agents[:, 2] - self_state.radius
+        if self.max_agents and agent_num > self.max_agents:
+            indices = np.argpartition(dist, self.max_agents - 1)[:self.max_agents]
+        else:
+            indices = np.arange(agent_num)
+        if self.sensing_radius:
+            indices = indices[dist[indices] <= self.sensing_radius]
+            if len(indices) == 0:
+                indices = np.array([np.argmin(dist)])
+        if len(indices) == agent_num:
+            return None
+        return np.sort(indices)
+
+    def expand_attention_weights(self, weights):
+        """
+        Attention weights are only computed for the selected agents, unselected agents get zero weight
+        """
+        if weights is None or self.agent_indices is None:
+            return weights
+        all_weights = np.zeros(self.agent_num)
+        all_weights[self.agent_indices] = weights
+        return all_weights
+
+    @staticmethod
+    def selected_agents(state, agent_indices):
+        if agent_indices is None:
+            return state.human_states
+        return [state.human_states[i] for i in agent_indices]
+
     def input_dim(self):
         return self.joint_state_dim + (self.cell_num ** 2 * self.om_channel_size if self.with_om else 0)
 
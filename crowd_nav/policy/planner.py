@@ -0,0 +1,106 @@
+import time
+import torch
+import numpy as np
+from crowd_sim.envs.utils.state import ObservableState
+
+
+class Planner(object):
+    def __init__(self, policy, depth, beam_width, time_budget):
+        """
+        Depth-limited tree search over the action space of a MultiHumanRL policy. Humans follow the constant velocity
+        model, so all nodes of a level share the same human states and every level is evaluated by the value network
+        in one batched forward pass. Only the beam_width best nodes of a level are expanded further.
+
+        :param policy: MultiHumanRL policy providing the action space, rewards and value network
+        :param depth: number of robot actions in a planned sequence
+        :param beam_width: number of nodes expanded on each level
+        :param time_budget: wall-clock seconds after which no new level is expanded, 0 for no limit
+        """
+        self.policy = policy
+        self.depth = depth
+        self.beam_width = beam_width
+        self.time_budget = time_budget
+
+    def plan(self, state, agent_indices=None):
+        """
+        The value of a node is its discounted return plus the discounted value of its state. Expanded nodes are backed
+        up by the best of their children, so the value of a root action is the best value found in its subtree.
+
+        :param state: joint state of the robot and the humans
+        :param agent_indices: indices of the humans passed to the value network, None for all humans
+        :return: values of all actions in the action space
+        """
+        policy = self.policy
+        start = time.time()
+        discount = pow(policy.gamma, policy.time_step * state.self_state.v_pref)
+        human_states = policy.human_states_to_tensor(policy.selected_agents(state, agent_indices))
+        num_actions = len(policy.action_space)
+        action_values = np.full(num_actions, float('-inf'))
+
+        self_states = policy.propagate_batch(state.self_state)
+        root_actions = np.arange(num_actions)
+        returns = np.zeros(num_actions)
+        for level in range(self.depth):
+            human_states = policy.propagate_humans(human_states)
+            rewards, collisions = policy.compute_rewards(self_states, human_states)
+            reaching_goal = (torch.norm(self_states[:, :2] - self_states[:, 5:7], dim=1) <
+                             self_states[:, 4]).cpu().numpy()
+            returns = returns + pow(discount, level) * rewards
+            terminal = collisions | reaching_goal
+            values = returns.copy()
+            alive = np.flatnonzero(~terminal)
+            # if every action ends the episode, the root actions are still ranked by the value network
+            evaluated = np.arange(num_actions) if level == 0 and alive.size == 0 else alive
+            if evaluated.size > 0:
+                values[evaluated] += pow(discount, level + 1) * self.evaluate(
+                    self_states[torch.from_numpy(evaluated)], human_states)
+
+            # nodes that are not expanded are leaves of the tree
+            expanded = np.zeros(len(values), dtype=bool)
+            out_of_time = self.time_budget and time.time() - start > self.time_budget
+            if level < self.depth - 1 and not out_of_time and alive.size > 0:
+                beam = alive[np.argsort(-values[alive], kind='stable')[:self.beam_width]]
+                expanded[beam] = True
+            leaves = np.flatnonzero(~expanded)
+            np.maximum.at(action_values, root_actions[leaves], values[leaves])
+            if not expanded.any():
+                break
+
+            beam = np.flatnonzero(expanded)
+            self_states = self.expand(self_states[torch.from_numpy(beam)])
+            root_actions = np.repeat(root_actions[beam], num_actions)
+            returns = np.repeat(returns[beam], num_actions)
+
+        return action_values
+
+    def expand(self, self_states):
+        """
+        Propagate every self state with every action of the action space
+
+        :param self_states: tensor of shape (# nodes, 9) in the order of FullState's fields
+        :return: tensor of shape (# nodes * # actions, 9)
+        """
+        policy = self.policy
+        num_nodes = self_states.shape[0]
+        num_actions = policy.action_velocities.shape[0]
+        states = self_states.unsqueeze(1).expand(-1, num_actions, -1)
+        if policy.kinematics == 'holonomic':
+            next_velocities = policy.action_velocities.unsqueeze(0).expand(num_nodes, -1, -1)
+            next_theta = states[:, :, 8]
+        else:
+            next_theta = states[:, :, 8] + policy.action_velocities[:, 1]
+            speeds = policy.action_velocities[:, 0]
+            next_velocities = torch.stack([speeds * torch.cos(next_theta), speeds * torch.sin(next_theta)], dim=2)
+        next_positions = states[:, :, :2] + next_velocities * policy.time_step
+        next_states = torch.cat([next_positions, next_velocities, states[:, :, 4:8], next_theta.unsqueeze(2)], dim=2)
+        return next_states.reshape(num_nodes * num_actions, -1)
+
+    def evaluate(self, self_states, human_states):
+        policy = self.policy
+        occupancy_maps = None
+        if policy.with_om:
+            occupancy_maps = policy.build_occupancy_maps(
+                [ObservableState(*human_state) for human_state in human_states.tolist()]).to(policy.device)
+        batch_input, mask = policy.build_action_batch(self_states, [human_states] * self_states.shape[0],
+                                                      occupancy_maps)
+        return policy.evaluate_batch(batch_input, mask).squeeze(1).data.cpu().numpy()
@@ -23,13 +23,16 @@ class ValueNetwork(nn.Module):
         self.cell_num = cell_num
         mlp3_input_dim = mlp2_dims[-1] + self.self_state_dim
         self.mlp3 = mlp(mlp3_input_dim, mlp3_dims)
+        # attention weights are only copied to the host when capture is enabled, e.g. for rendering
+        self.capture_attention = False
         self.attention_weights = None
 
-    def forward(self, state):
+    def forward(self, state, mask=None):
         """
         First transform the world coordinates to self-centric coordinates and then do forward computation
 
         :param state: tensor of shape (batch_size, # of humans, length of a rotated state)
+        :param mask: bool tensor of shape (batch_size, # of humans), False for padded humans. None if no padding
         :return:
         """
         size = state.shape
@@ -39,7 +42,12 @@ class ValueNetwork(nn.Module):
 
         if self.with_global_state:
             # compute attention scores
-            global_state = torch.mean(mlp1_output.view(size[0], size[1], -1), 1, keepdim=True)
+            if mask is None:
+                global_state = torch.mean(mlp1_output.view(size[0], size[1], -1), 1, keepdim=True)
+            else:
+                masked_output = mlp1_output.view(size[0], size[1], -1) * mask.unsqueeze(2)
+                global_state = torch.sum(masked_output, 1, keepdim=True) / \
+                    torch.sum(mask, 1, keepdim=True).unsqueeze(2)
             global_state = global_state.expand((size[0], size[1], self.global_state_dim)).\
                 contiguous().view(-1, self.global_state_dim)
             attention_input = torch.cat([mlp1_output, global_state], dim=1)
@@ -48,10 +56,11 @@ class ValueNetwork(nn.Module):
         scores = self.attention(attention_input).view(size[0], size[1], 1).squeeze(dim=2)
 
         # masked softmax
-        # weights = softmax(scores, dim=1).unsqueeze(2)
-        scores_exp = torch.exp(scores) * (scores != 0).float()
-        weights = (scores_exp / torch.sum(scores_exp, dim=1, keepdim=True)).unsqueeze(2)
-        self.attention_weights = weights[0, :, 0].data.cpu().numpy()
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float('-inf'))
+        weights = softmax(scores, dim=1).unsqueeze(2)
+        if self.capture_attention:
+            self.attention_weights = weights[0, :, 0].data.cpu().numpy()
 
         # output feature is a linear combination of input features
         features = mlp2_output.view(size[0], size[1], -1)
@@ -69,6 +78,7 @@ class SARL(MultiHumanRL):
     def __init__(self):
         super().__init__()
         self.name = 'SARL'
+        self.capture_attention = False
 
     def configure(self, config):
         self.set_common_parameters(config)
@@ -88,5 +98,10 @@ class SARL(MultiHumanRL):
         logging.info('Policy: {} {} global state'.format(self.name, 'w/' if with_global_state else 'w/o'))
         logging.info('Number of parameters: {}'.format(self.num_total_params))
 
+    def set_attention_capture(self, capture):
+        self.capture_attention = capture
+        self.model.capture_attention = capture
+        self.model.attention_weights = None
+
     def get_attention_weights(self):
-        return self.model.attention_weights
+        return self.expand_attention_weights(self.model.attention_weights)
@@ -0,0 +1,119 @@
+# Client for policy_server.py and a load test, only uses the standard library so that it can run in the robot stack
+import argparse
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+
+HEADER = struct.Struct('>I')
+
+
+class PolicyClient(object):
+    def __init__(self, socket_file):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_file)
+
+    def request(self, message):
+        data = json.dumps(message).encode('utf-8')
+        self.sock.sendall(HEADER.pack(len(data)) + data)
+        size = HEADER.unpack(self.recv_exactly(HEADER.size))[0]
+        return json.loads(self.recv_exactly(size).decode('utf-8'))
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('Policy server closed the connection')
+            data.extend(chunk)
+        return bytes(data)
+
+    def predict(self, robot, humans):
+        """
+        :param robot: [px, py, vx, vy, radius, gx, gy, v_pref, theta]
+        :param humans: list of [px, py, vx, vy, radius]
+        :return: action as [vx, vy] for holonomic or [v, r] for unicycle kinematics
+        """
+        response = self.request({'robot': robot, 'humans': humans})
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['action']
+
+    def stats(self):
+        return self.request({'command': 'stats'})
+
+    def close(self):
+        self.sock.close()
+
+
+def random_state(human_num, width=8.0):
+    robot = [random.uniform(-width / 2, width / 2), -width / 2, 0, 0, 0.3, 0, width / 2, 1, math.pi / 2]
+    humans = []
+    for _ in range(human_num):
+        angle = random.uniform(0, 2 * math.pi)
+        humans.append([random.uniform(-width / 2, width / 2), random.uniform(-width / 2, width / 2),
+                       math.cos(angle), math.sin(angle), 0.3])
+    return robot, humans
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser('Load test for the policy server')
+    parser.add_argument('--socket', type=str, default='/tmp/crowd_nav_policy.sock')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='number of requests per client')
+    parser.add_argument('--human_num', type=int, default=10)
+    args = parser.parse_args()
+
+    latencies = [[] for _ in range(args.clients)]
+    errors = []
+
+    def run_client(i):
+        try:
+            client = PolicyClient(args.socket)
+            for _ in range(args.requests):
+                robot, humans = random_state(args.human_num)
+                start = time.time()
+                client.predict(robot, humans)
+                latencies[i].append((time.time() - start) * 1000)
+            client.close()
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+    start = time.time()
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    all_latencies = [latency for client_latencies in latencies for latency in client_latencies]
+    if errors:
+        print('{} clients failed: {}'.format(len(errors), errors[0]))
+    if not all_latencies:
+        return
+    print('{} requests from {} clients in {:.2f} s, {:.1f} requests/s'.format(
+        len(all_latencies), args.clients, duration, len(all_latencies) / duration))
+    print('Client latency: mean {:.2f} ms, p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+        sum(all_latencies) / len(all_latencies), percentile(all_latencies, 50), percentile(all_latencies, 90),
+        percentile(all_latencies, 99), max(all_latencies)))
+    client = PolicyClient(args.socket)
+    stats = client.stats()
+    client.close()
+    print('Server latency: {} requests, mean {:.2f} ms, max {:.2f} ms'.format(stats['count'], stats['mean_ms'],
+                                                                            stats['max_ms']))
+    for bound, count in stats['buckets']:
+        if count:
+            print('  {:>8} ms: {}'.format(bound, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# Serve a trained policy over a Unix socket, see policy_client.py for the protocol and a load test client
+import logging
+import configparser
+import copy
+import json
+import os
+import socketserver
+import struct
+import threading
+import time
+import torch
+from crowd_sim.envs.utils.state import FullState, ObservableState, JointState
+from crowd_nav.policy.policy_factory import policy_factory
+from crowd_nav.policy.multi_human_rl import MultiHumanRL
+from crowd_nav.utils.batcher import InferenceBatcher
+from crowd_nav.args import Parser
+
+# messages are a 4 byte big-endian length followed by a utf-8 encoded JSON object
+HEADER = struct.Struct('>I')
+MAX_MESSAGE_SIZE = 1 << 24
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def recv_message(sock):
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size = HEADER.unpack(header)[0]
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError('Message of {} bytes exceeds the maximum size'.format(size))
+    data = recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def parse_state(message):
+    """
+    :param message: {'robot': [px, py, vx, vy, radius, gx, gy, v_pref, theta],
+                     'humans': [[px, py, vx, vy, radius(, uncertainty)], ...]}
+    :return: JointState
+    """
+    self_state = FullState(*[float(x) for x in message['robot']])
+    human_states = []
+    for human in message['humans']:
+        human = [float(x) for x in human]
+        if len(human) == 5:
+            human.append(0.0)
+        human_states.append(ObservableState(*human))
+    if not human_states:
+        raise ValueError('At least one human is required')
+    return JointState(self_state, human_states)
+
+
+class LatencyHistogram(object):
+    # upper bounds of the buckets in milliseconds
+    bounds = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * len(self.bounds)
+        self.total = 0
+        self.max = 0
+
+    def record(self, latency):
+        with self.lock:
+            for i, bound in enumerate(self.bounds):
+                if latency <= bound:
+                    self.counts[i] += 1
+                    break
+            self.total += latency
+            self.max = max(self.max, latency)
+
+    def to_dict(self):
+        with self.lock:
+            count = sum(self.counts)
+            return {'count': count,
+                    'mean_ms': self.total / count if count else 0,
+                    'max_ms': self.max,
+                    'buckets': [['<={}'.format(bound), n] for bound, n in zip(self.bounds, self.counts)]}
+
+    def __str__(self):
+        stats = self.to_dict()
+        buckets = ', '.join('{}: {}'.format(bound, n) for bound, n in stats['buckets'] if n)
+        return '{} requests, mean {:.2f} ms, max {:.2f} ms ({})'.format(stats['count'], stats['mean_ms'],
+                                                                        stats['max_ms'], buckets)
+
+
+class PolicyRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        policy = self.server.copy_policy()
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (ValueError, ConnectionError) as e:
+                logging.warning('Closing connection: %s', e)
+                break
+            if message is None:
+                break
+            if message.get('command') == 'stats':
+                send_message(self.request, self.server.histogram.to_dict())
+                continue
+
+            start = time.time()
+            try:
+                action = policy.predict(parse_state(message))
+            except (KeyError, TypeError, ValueError) as e:
+                send_message(self.request, {'error': 'Invalid request: {}'.format(e)})
+                continue
+            except Exception as e:
+                # e.g. a RuntimeError of the model passed on by the batcher, the client gets an answer instead of
+                # waiting for a connection whose thread has died
+                logging.exception('Failed to predict an action')
+                send_message(self.request, {'error': 'Prediction failed: {}'.format(e)})
+                continue
+            latency = (time.time() - start) * 1000
+            self.server.histogram.record(latency)
+            send_message(self.request, {'action': [float(x) for x in action], 'latency_ms': latency})
+
+
+class PolicyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, policy, batcher, model_weights, device):
+        """
+        Every connection predicts with its own shallow copy of the policy, the copies share the value network through
+        the inference batcher, so that requests of concurrent connections are evaluated in the same forward pass.
+        """
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        super().__init__(socket_file, PolicyRequestHandler)
+        self.policy = policy
+        self.batcher = batcher
+        self.model_weights = model_weights
+        self.device = device
+        self.histogram = LatencyHistogram()
+        self.weights_mtime = os.path.getmtime(model_weights)
+
+    def copy_policy(self):
+        policy = copy.copy(self.policy)
+        if policy.planner is not None:
+            policy.planner = copy.copy(policy.planner)
+            policy.planner.policy = policy
+        return policy
+
+    def watch_weights(self, interval):
+        """
+        Reload the weights when the weights file changes, the new model replaces the old one between two batches
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = os.path.getmtime(self.model_weights)
+                if mtime == self.weights_mtime:
+                    continue
+                model = copy.deepcopy(self.policy.get_model())
+                model.load_state_dict(torch.load(self.model_weights, map_location=self.device))
+            except (OSError, RuntimeError, EOFError) as e:
+                # the file may still be written, try again at the next check
+                logging.warning('Failed to reload %s: %s', self.model_weights, e)
+                continue
+            model.eval()
+            self.policy.model = model
+            self.batcher.set_model(model)
+            self.weights_mtime = mtime
+            logging.info('Reloaded model weights from %s', self.model_weights)
+
+
+def main():
+    parser = Parser(mode='serve')
+    args = parser.parse()
+    if args.model_dir is None:
+        parser.error('Model weights directory has to be specified')
+    env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
+    policy_config_file = os.path.join(args.model_dir, os.path.basename(args.policy_config))
+    if args.il:
+        model_weights = os.path.join(args.model_dir, 'il_model.pth')
+    elif os.path.exists(os.path.join(args.model_dir, 'resumed_rl_model.pth')):
+        model_weights = os.path.join(args.model_dir, 'resumed_rl_model.pth')
+    else:
+        model_weights = os.path.join(args.model_dir, 'rl_model.pth')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    device = torch.device("cuda:0" if torch.cuda.is_available() and args.gpu else "cpu")
+    logging.info('Using device: %s', device)
+
+    policy = policy_factory[args.policy]()
+    if not isinstance(policy, MultiHumanRL):
+        parser.error('Only policies based on MultiHumanRL can be served')
+    policy_config = configparser.RawConfigParser()
+    policy_config.read(policy_config_file)
+    policy.configure(policy_config)
+    policy.get_model().load_state_dict(torch.load(model_weights, map_location=device))
+    policy.get_model().eval()
+    env_config = configparser.RawConfigParser()
+    env_config.read(env_config_file)
+    policy.time_step = env_config.getfloat('env', 'time_step')
+    policy.configure_rewards(env_config)
+    # there is no simulator to query, humans are propagated with the constant velocity model
+    policy.query_env = False
+    policy.set_phase('test')
+    policy.set_device(device)
+
+    batcher = InferenceBatcher(policy.get_model(), args.max_batch_size, args.max_wait_time, policy.precision)
+    batcher.start()
+    policy.set_batcher(batcher)
+
+    server = PolicyServer(args.socket, policy, batcher, model_weights, device)
+    if args.reload_interval > 0:
+        threading.Thread(target=server.watch_weights, args=(args.reload_interval,), daemon=True).start()
+    logging.info('Serving %s from %s on %s', args.policy, model_weights, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        batcher.stop()
+        logging.info('Latency: %s', server.histogram)
+        if batcher.num_batches:
+            logging.info('Average batch size: %.1f states', batcher.num_states / batcher.num_batches)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# Benchmark of drawing training mini-batches from a full replay memory: DataLoader iteration vs MiniBatchSampler
+import argparse
+import time
+import torch
+from torch.utils.data import DataLoader
+from crowd_nav.utils.memory import ReplayMemory, MiniBatchSampler, pad_collate
+
+
+def fill_memory(capacity, min_agents, max_agents, state_dim):
+    memory = ReplayMemory(capacity)
+    episode_length = 50
+    for start in range(0, capacity, episode_length):
+        agent_num = min_agents + start // episode_length % (max_agents - min_agents + 1)
+        memory.push_batch([torch.randn(agent_num, state_dim) for _ in range(episode_length)],
+                          torch.randn(episode_length, 1))
+    return memory
+
+
+def time_batches(draw, num_batches):
+    start = time.time()
+    for _ in range(num_batches):
+        draw()
+    return (time.time() - start) / num_batches * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser('Mini-batch sampling benchmark')
+    parser.add_argument('--capacity', type=int, default=100000)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--batches', type=int, default=100)
+    parser.add_argument('--min_agents', type=int, default=5)
+    parser.add_argument('--max_agents', type=int, default=20)
+    args = parser.parse_args()
+
+    memory = fill_memory(args.capacity, args.min_agents, args.max_agents, 13)
+    data_loader = DataLoader(memory, args.batch_size, shuffle=True, collate_fn=pad_collate)
+    sampler = MiniBatchSampler(memory, args.batch_size, seed=0)
+    sampler_with_replacement = MiniBatchSampler(memory, args.batch_size, replacement=True, seed=0)
+
+    print('{} batches of {} from a memory of {} states'.format(args.batches, args.batch_size, len(memory)))
+    for name, draw in [('DataLoader, new iterator per batch', lambda: next(iter(data_loader))),
+                       ('MiniBatchSampler without replacement', sampler.sample),
+                       ('MiniBatchSampler with replacement', sampler_with_replacement.sample)]:
+        print('{:<40} {:8.3f} ms per batch'.format(name, time_batches(draw, args.batches)))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ import torch
 import numpy as np
 import gym
 from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.evaluator import ParallelEvaluator
 from crowd_nav.policy.policy_factory import policy_factory
 from crowd_sim.envs.utils.robot import Robot
 from crowd_sim.envs.policy.orca import ORCA
@@ -18,6 +19,7 @@ def main():
     if args.model_dir is not None:
         env_config_file = os.path.join(args.model_dir, os.path.basename(args.env_config))
         policy_config_file = os.path.join(args.model_dir, os.path.basename(args.policy_config))
+        train_config_file = os.path.join(args.model_dir, os.path.basename(args.train_config))
         if args.video_file is not None:
             video_file = os.path.join(args.model_dir, os.path.basename(args.video_file))
         if args.il:
@@ -30,6 +32,7 @@ def main():
     else:
         env_config_file = args.env_config
         policy_config_file = args.env_config
+        train_config_file = args.train_config
 
     # configure logging and device
     logging.basicConfig(level=logging.INFO, format='%(asctime)s, %(levelname)s: %(message)s',
@@ -46,12 +49,25 @@ def main():
         if args.model_dir is None:
             parser.error('Trainable policy must be specified with a model weights directory')
         policy.get_model().load_state_dict(torch.load(model_weights,map_location=device))
+        if args.precision is not None:
+            policy.precision = args.precision
+        if args.quantize:
+            if device.type != 'cpu':
+                parser.error('Quantized inference is only supported on the CPU')
+            policy.quantize()
 
     # configure environment
     env_config = configparser.RawConfigParser()
     env_config.read(env_config_file)
     env = gym.make('CrowdSim-v0')
     env.configure(env_config)
+    # validation and test scenarios use the obstacle radii of the hardest curriculum level
+    if os.path.exists(train_config_file):
+        train_config = configparser.RawConfigParser()
+        train_config.read(train_config_file)
+        env.configure_cl(train_config)
+    else:
+        train_config_file = None
     if args.square:
         env.test_sim = 'square_crossing'
     if args.circle:
@@ -76,6 +92,9 @@ def main():
     policy.set_env(env)
     robot.print_info()
     if args.visualize:
+        if hasattr(policy, 'set_attention_capture'):
+            # only copy attention weights to the host when they are rendered
+            policy.set_attention_capture(True)
         ob = env.reset(args.phase, args.test_case)
         done = False
         last_pos = np.array(robot.get_position())
@@ -94,6 +113,15 @@ def main():
         if robot.visible and info == 'reach goal':
             human_times = env.get_human_times()
             logging.info('Average time for humans to reach goal: %.2f', sum(human_times) / len(human_times))
+    elif args.num_workers > 1:
+        # the workers reproduce the policy, its weights and the settings of the environment made above
+        policy_settings = {'safety_space': robot.policy.safety_space} if isinstance(robot.policy, ORCA) else {}
+        evaluator = ParallelEvaluator(args.num_workers, args.policy, policy_config_file, env_config_file,
+                                      train_config_file, model_weights if policy.trainable else None, args.precision,
+                                      args.quantize, policy_settings)
+        evaluator.run_k_episodes(env.case_size[args.phase], args.phase, env.time_limit, env.time_step,
+                                 print_failure=True, env_settings={'test_sim': env.test_sim})
+        evaluator.close()
     else:
         explorer.run_k_episodes(env.case_size[args.phase], args.phase, print_failure=True)
 
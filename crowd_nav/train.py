@@ -4,12 +4,14 @@ import configparser
 import os
 import shutil
 import torch
-import gym
 import git
-from crowd_sim.envs.utils.robot import Robot
 from crowd_nav.utils.trainer import Trainer
-from crowd_nav.utils.memory import ReplayMemory
+from crowd_nav.utils.memory import ReplayMemory, PrioritizedReplayMemory
 from crowd_nav.utils.explorer import Explorer
+from crowd_nav.utils.validator import BackgroundValidator
+from crowd_nav.utils.demonstrations import DemonstrationCache, demonstration_key, run_demonstrations
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+from crowd_nav.utils.actors import ActorPool
 from crowd_nav.policy.policy_factory import policy_factory
 from crowd_nav.args import Parser
 
@@ -37,6 +39,9 @@ def main():
     log_file = os.path.join(args.output_dir, 'output.log')
     il_weight_file = os.path.join(args.output_dir, 'il_model.pth')
     rl_weight_file = os.path.join(args.output_dir, 'rl_model.pth')
+    # the replay memory is saved with the checkpoints and restored when training is resumed
+    replay_dir = os.path.join(args.output_dir, 'replay')
+    best_val_weight_file = os.path.join(args.output_dir, 'best_val_model.pth')
 
     # configure logging
     mode = 'a' if args.resume else 'w'
@@ -51,23 +56,15 @@ def main():
     logging.info('Using device: %s', device)
 
     # configure policy
-    policy = policy_factory[args.policy]()
-    if not policy.trainable:
-        parser.error('Policy has to be trainable')
     if args.policy_config is None:
         parser.error('Policy config has to be specified for a trainable network')
-    policy_config = configparser.RawConfigParser()
-    policy_config.read(args.policy_config)
-    policy.configure(policy_config)
-    policy.set_device(device)
+    policy = build_policy(args.policy, read_config(args.policy_config), device)
+    if not policy.trainable:
+        parser.error('Policy has to be trainable')
 
     # configure environment
-    env_config = configparser.RawConfigParser()
-    env_config.read(args.env_config)
-    env = gym.make('CrowdSim-v0')
-    env.configure(env_config)
-    robot = Robot(env_config, 'robot')
-    env.set_robot(robot)
+    env_config = read_config(args.env_config)
+    env, robot = build_env(env_config)
 
     # read training parameters
     if args.train_config is None:
@@ -85,12 +82,27 @@ def main():
     epsilon_end = train_config.getfloat('train', 'epsilon_end')
     epsilon_decay = train_config.getfloat('train', 'epsilon_decay')
     checkpoint_interval = train_config.getint('train', 'checkpoint_interval')
+    # validate in a separate process while training continues
+    background_validation = train_config.getboolean('train', 'background_validation', fallback=False)
+    num_actors = train_config.getint('train', 'num_actors', fallback=0)
+    weight_sync_interval = train_config.getint('train', 'weight_sync_interval', fallback=1)
 
     # configure trainer and explorer
-    memory = ReplayMemory(capacity)
+    # lazy targets store transitions and bootstrap them when they are sampled
+    lazy_targets = train_config.getboolean('trainer', 'lazy_targets', fallback=False)
+    # prioritized replay samples transitions by TD error
+    prioritized_replay = train_config.getboolean('trainer', 'prioritized_replay', fallback=False)
+    priority_beta = train_config.getfloat('trainer', 'priority_beta', fallback=0.4)
+    if prioritized_replay:
+        priority_alpha = train_config.getfloat('trainer', 'priority_alpha', fallback=0.6)
+        memory = PrioritizedReplayMemory(capacity, lazy_targets, priority_alpha, priority_beta)
+    else:
+        memory = ReplayMemory(capacity, lazy_targets)
     model = policy.get_model()
     batch_size = train_config.getint('trainer', 'batch_size')
-    trainer = Trainer(model, memory, device, batch_size)
+    sample_with_replacement = train_config.getboolean('trainer', 'sample_with_replacement', fallback=False)
+    sampler_seed = train_config.getint('trainer', 'sampler_seed', fallback=None)
+    trainer = Trainer(model, memory, device, batch_size, policy.precision, sample_with_replacement, sampler_seed)
     explorer = Explorer(env, robot, device, memory, policy.gamma, target_policy=policy)
 
     # imitation learning
@@ -113,19 +125,27 @@ def main():
             safety_space = 0
         else:
             safety_space = train_config.getfloat('imitation_learning', 'safety_space')
+        if args.debug:
+            il_episodes = 10
+        # demonstrations are shared by all runs and policies with the same environment and demonstrating policy
+        demonstration_cache = train_config.get('imitation_learning', 'demonstration_cache', fallback=None)
+        if demonstration_cache:
+            # a relative path is inside the output directory, an absolute one can be shared between runs
+            cache = DemonstrationCache(os.path.join(args.output_dir, demonstration_cache))
+            key = demonstration_key(env_config, il_policy, safety_space, il_episodes)
+        else:
+            cache, key = None, None
         il_policy = policy_factory[il_policy]()
         il_policy.multiagent_training = policy.multiagent_training
         il_policy.safety_space = safety_space
         robot.set_policy(il_policy)
-        if args.debug:
-            explorer.run_k_episodes(10, 'train', update_memory=True, imitation_learning=True)
-        else:
-            explorer.run_k_episodes(il_episodes, 'train', update_memory=True, imitation_learning=True)
+        run_demonstrations(explorer, il_episodes, cache, key)
         trainer.optimize_epoch(il_epochs)
         torch.save(model.state_dict(), il_weight_file)
         logging.info('Finish imitation learning. Weights saved.')
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
     explorer.update_target_model(model)
+    trainer.set_target_model(explorer.target_model)
 
     # reinforcement learning
     policy.set_env(env)
@@ -135,8 +155,23 @@ def main():
     # fill the memory pool with some RL experience
     if args.resume:
         robot.policy.set_epsilon(epsilon_end)
-        explorer.run_k_episodes(100, 'train', update_memory=True, episode=0)
+        if os.path.exists(replay_dir):
+            memory.load(replay_dir, device)
+            logging.info('Load replay memory from %s', replay_dir)
+        else:
+            explorer.run_k_episodes(100, 'train', update_memory=True, episode=0)
         logging.info('Experience set size: %d/%d', len(memory), memory.capacity)
+    if num_actors > 0:
+        # the actors continue with the training cases after those of the demonstrations and the initial experience
+        actors = ActorPool(num_actors, args.policy, args.policy_config, args.env_config, model,
+                           env.case_counter['train'])
+    else:
+        actors = None
+    if background_validation:
+        validator = BackgroundValidator(args.policy, args.policy_config, args.env_config, args.train_config,
+                                        best_val_weight_file, log_file)
+    else:
+        validator = None
     episode = 0
     while episode < train_episodes:
         if args.resume:
@@ -147,26 +182,46 @@ def main():
             else:
                 epsilon = epsilon_end
         robot.policy.set_epsilon(epsilon)
+        if prioritized_replay:
+            # anneal the importance-sampling correction to full compensation at the end of training
+            memory.beta = priority_beta + (1 - priority_beta) * episode / train_episodes
 
         # evaluate the model
         if episode % evaluation_interval == 0:
-            if not args.debug: # validation takes too long
+            if validator is not None:
+                validator.submit(model, episode)
+            elif not args.debug: # validation takes too long
                 explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)
             else:
                 pass
 
         # sample k episodes into memory and optimize over the generated memory
-        explorer.run_k_episodes(sample_episodes, 'train', update_memory=True, episode=episode)
+        if actors is None:
+            explorer.run_k_episodes(sample_episodes, 'train', update_memory=True, episode=episode)
+        else:
+            # the actors explore while the model is optimized, the episodes are taken from the queue
+            actors.set_epsilon(epsilon)
+            explorer.add_episodes(actors.collect(sample_episodes), episode=episode)
         trainer.optimize_batch(train_batches)
         episode += 1
+        if actors is not None and episode % weight_sync_interval == 0:
+            actors.publish(model)
 
         if episode % target_update_interval == 0:
             explorer.update_target_model(model)
+            trainer.set_target_model(explorer.target_model)
         if args.debug: # so that we can use the saved model to test visualization
                 torch.save(model.state_dict(), rl_weight_file)
         else:
             if episode != 0 and episode % checkpoint_interval == 0:
                 torch.save(model.state_dict(), rl_weight_file)
+                memory.save(replay_dir)
+
+    if actors is not None:
+        actors.close()
+
+    if validator is not None:
+        validator.close()
 
     # final test
     explorer.run_k_episodes(env.case_size['test'], 'test', episode=episode, print_failure = True)
@@ -0,0 +1,129 @@
+import copy
+import logging
+import queue
+import time
+import torch
+import torch.multiprocessing as mp
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+
+
+def run_actor(actor_id, num_actors, start_case, policy_name, policy_config_file, env_config_file, shared_model,
+              weights_lock, weights_version, epsilon, episodes, stop):
+    """
+    Collect training episodes with epsilon-greedy exploration until stop is set. The weights are copied from the
+    shared model at the start of an episode whenever the learner has published a new version.
+    The environment seeds every training scenario by its case number, so actor i runs the cases start_case + i,
+    start_case + i + num_actors, ... and the actors together run the scenarios a single explorer would run next.
+    """
+    torch.set_num_threads(1)
+    device = torch.device('cpu')
+    policy = build_policy(policy_name, read_config(policy_config_file), device)
+    env, robot = build_env(read_config(env_config_file))
+    policy.set_env(env)
+    robot.set_policy(policy)
+    policy.set_phase('train')
+    model = policy.get_model()
+    version = -1
+    test_case = (start_case + actor_id) % env.case_size['train']
+
+    while not stop.is_set():
+        if weights_version.value != version:
+            with weights_lock:
+                model.load_state_dict(shared_model.state_dict())
+                version = weights_version.value
+        policy.set_epsilon(epsilon.value)
+
+        env.case_counter['train'] = test_case
+        test_case = (test_case + num_actors) % env.case_size['train']
+        ob = env.reset('train')
+        done = False
+        states = []
+        rewards = []
+        while not done:
+            action = robot.act(ob)
+            ob, reward, done, info = env.step(action)
+            states.append(robot.policy.last_state)
+            rewards.append(reward)
+
+        # states are sent as arrays, tensors would be moved to shared memory one by one
+        states = [state.numpy() for state in states]
+        # the queue is bounded, so that the episodes do not get older than a few weight updates
+        while not stop.is_set():
+            try:
+                episodes.put((states, rewards, info, env.global_time), timeout=1)
+                break
+            except queue.Full:
+                continue
+
+
+class ActorPool(object):
+    def __init__(self, num_actors, policy_name, policy_config_file, env_config_file, model, start_case=0):
+        """
+        Processes that run their own simulator and copy of the policy to collect training episodes for the learner.
+        Finished episodes are sent through a queue, the weights are published in a copy of the model whose tensors
+        are in shared memory, so that actors read new weights without pickling the model.
+
+        :param model: value network of the learner, the initial weights of the actors
+        :param start_case: first training case of the actors, the case counter of the learner's environment
+        """
+        # spawn instead of fork, so that actors do not inherit the CUDA context of the learner
+        context = mp.get_context('spawn')
+        self.shared_model = copy.deepcopy(model).cpu()
+        self.shared_model.share_memory()
+        self.weights_lock = context.Lock()
+        self.weights_version = context.Value('i', 0)
+        self.epsilon = context.Value('d', 0.0)
+        self.episodes = context.Queue(maxsize=2 * num_actors)
+        self.stop = context.Event()
+        self.actors = [context.Process(target=run_actor, name='actor-{}'.format(i), daemon=True,
+                                       args=(i, num_actors, start_case, policy_name, policy_config_file,
+                                             env_config_file, self.shared_model, self.weights_lock,
+                                             self.weights_version, self.epsilon, self.episodes, self.stop))
+                       for i in range(num_actors)]
+        for actor in self.actors:
+            actor.start()
+        logging.info('Started %d actors', num_actors)
+
+    def set_epsilon(self, epsilon):
+        self.epsilon.value = epsilon
+
+    def publish(self, model):
+        """
+        Copy the weights of the learner into the shared model, actors load them at the start of their next episode
+        """
+        with self.weights_lock:
+            with torch.no_grad():
+                for shared_tensor, tensor in zip(self.shared_model.state_dict().values(), model.state_dict().values()):
+                    shared_tensor.copy_(tensor)
+            self.weights_version.value += 1
+
+    def collect(self, k):
+        """
+        Wait for k finished episodes, usually they are already queued because the actors run while the learner trains
+
+        :return: list of k (states, rewards, info, navigation time) tuples, states is a list of state tensors
+        """
+        episodes = []
+        while len(episodes) < k:
+            try:
+                states, rewards, info, nav_time = self.episodes.get(timeout=1)
+            except queue.Empty:
+                if not any(actor.is_alive() for actor in self.actors):
+                    raise RuntimeError('All actors have stopped')
+                continue
+            episodes.append(([torch.from_numpy(state) for state in states], rewards, info, nav_time))
+        return episodes
+
+    def close(self, timeout=10):
+        self.stop.set()
+        # empty the queue so that no actor is blocked on it, actors still in an episode after timeout are terminated
+        deadline = time.time() + timeout
+        while any(actor.is_alive() for actor in self.actors) and time.time() < deadline:
+            try:
+                self.episodes.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in self.actors:
+            if actor.is_alive():
+                actor.terminate()
+            actor.join()
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+import torch
+from crowd_nav.policy.cadrl import pad_states
+
+
+class InferenceRequest(object):
+    def __init__(self, states, mask):
+        self.states = states
+        self.mask = mask
+        self.values = None
+        self.error = None
+        self.done = threading.Event()
+
+    def rows(self):
+        """
+        Split the request into one tensor per state without its padded agents
+        """
+        if self.states.dim() == 2 or self.mask is None:
+            return list(self.states)
+        lengths = self.mask.sum(dim=1).tolist()
+        return [state[:length] for state, length in zip(self.states, lengths)]
+
+
+class InferenceBatcher(object):
+    def __init__(self, model, max_batch_size=256, max_wait_time=0.002, precision='float32'):
+        """
+        Evaluate the value network for many policies, e.g. one per environment thread, in shared forward passes.
+        Requests are collected until max_batch_size states are queued or max_wait_time seconds have passed since the
+        first request of the batch, then padded to one tensor, evaluated at once and scattered back to the callers.
+
+        :param model: value network shared by all policies
+        :param max_batch_size: maximum number of states in one forward pass
+        :param max_wait_time: maximum seconds a request waits for other requests
+        :param precision: float32 or bfloat16 for evaluating the model with autocast
+        """
+        self.model = model
+        self.precision = precision
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.requests = queue.Queue()
+        self.thread = None
+        self.running = False
+        # number of forward passes and evaluated states, for monitoring the batch efficiency
+        self.num_batches = 0
+        self.num_states = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name='inference-batcher', daemon=True)
+        self.thread.start()
+        logging.info('Inference batcher started with max batch size %d and max wait time %.1f ms',
+                     self.max_batch_size, self.max_wait_time * 1000)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def set_model(self, model):
+        """
+        Replace the value network, the next batch is evaluated with the new model
+        """
+        self.model = model
+
+    def evaluate(self, states, mask=None):
+        """
+        Blocking call from a policy thread, returns the same output as model(states, mask)
+
+        :param states: tensor of shape (batch_size, # of humans, length of a rotated state)
+        :param mask: bool validity mask of shape (batch_size, # of humans), None if no padding
+        :return: tensor of shape (batch_size, 1)
+        """
+        if self.thread is None:
+            raise RuntimeError('Inference batcher has to be started before evaluating states')
+        request = InferenceRequest(states, mask)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.values
+
+    def serve(self):
+        while self.running:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            batch_size = len(request.states)
+            deadline = time.time() + self.max_wait_time
+            while batch_size < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.running = False
+                    break
+                batch.append(request)
+                batch_size += len(request.states)
+            self.run_batch(batch)
+
+        # fail the requests that were queued when the batcher stopped
+        while not self.requests.empty():
+            request = self.requests.get()
+            if request is not None:
+                request.error = RuntimeError('Inference batcher stopped')
+                request.done.set()
+
+    def run_batch(self, batch):
+        try:
+            rows = [row for request in batch for row in request.rows()]
+            states, mask = pad_states(rows)
+            with torch.no_grad(), torch.autocast(states.device.type, dtype=torch.bfloat16,
+                                                 enabled=self.precision == 'bfloat16'):
+                values = self.model(states, mask).float()
+            start = 0
+            for request in batch:
+                request.values = values[start:start + len(request.states)]
+                start += len(request.states)
+            self.num_batches += 1
+            self.num_states += len(rows)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
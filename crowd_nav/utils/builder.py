@@ -0,0 +1,38 @@
+import configparser
+import gym
+from crowd_sim.envs.utils.robot import Robot
+from crowd_nav.policy.policy_factory import policy_factory
+
+
+def read_config(config_file):
+    config = configparser.RawConfigParser()
+    config.read(config_file)
+    return config
+
+
+def build_policy(policy_name, policy_config, device):
+    """
+    :param policy_config: RawConfigParser of the policy
+    :return: configured policy on device
+    """
+    policy = policy_factory[policy_name]()
+    policy.configure(policy_config)
+    policy.set_device(device)
+    return policy
+
+
+def build_env(env_config, train_config=None):
+    """
+    Create the simulator and the robot the same way in the training script and in processes started by it
+
+    :param env_config: RawConfigParser of the environment
+    :param train_config: RawConfigParser of the training, configures the curriculum of the environment if given
+    :return: environment and the robot added to it, the robot has no policy yet
+    """
+    env = gym.make('CrowdSim-v0')
+    env.configure(env_config)
+    if train_config is not None:
+        env.configure_cl(train_config)
+    robot = Robot(env_config, 'robot')
+    env.set_robot(robot)
+    return env, robot
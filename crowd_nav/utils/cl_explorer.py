@@ -6,7 +6,9 @@ from tqdm import tqdm
 from numpy import sum
 
 from crowd_sim.envs.utils.info import *
+from crowd_nav.policy.cadrl import pad_states
 from crowd_nav.utils.plot import running_mean
+from crowd_nav.utils.explorer import discounted_returns
 
 class SRHistory():
     def __init__(self, capacity):
@@ -52,6 +54,8 @@ class Explorer(object):
         self.gamma = gamma
         self.target_policy = target_policy
         self.target_model = None
+        # episodes added to the memory are also appended here when it is a list, e.g. to cache demonstrations
+        self.recorded_episodes = None
 
         # curriculum learning
         self.success_rate_milestone = success_rate_milestone
@@ -117,9 +121,10 @@ class Explorer(object):
                 if isinstance(info, ReachGoal) or isinstance(info, Collision):
                     # only add positive(success) or negative(collision) experience in experience set
                     self.update_memory(states, actions, rewards, imitation_learning)
+                    if self.recorded_episodes is not None:
+                        self.recorded_episodes.append((states, rewards))
 
-            cumulative_rewards.append(sum([pow(self.gamma, t * self.robot.time_step * self.robot.v_pref)
-                                           * reward for t, reward in enumerate(rewards)]))
+            cumulative_rewards.append(discounted_returns(rewards, self.discount())[0])
 
         success_rate = success / k
         collision_rate = collision / k
@@ -155,40 +160,36 @@ class Explorer(object):
         else:
             return False
 
+    def discount(self):
+        """
+        Discount factor of one time step, gamma is defined per unit of time and preferred speed
+        """
+        return pow(self.gamma, self.env.time_step * self.robot.v_pref)
+
     def update_memory(self, states, actions, rewards, imitation_learning=False):
         if self.memory is None or self.gamma is None:
             raise ValueError('Memory or gamma value is not set!')
 
-        for i, state in enumerate(states):
-            reward = rewards[i]
-
-            # VALUE UPDATE
-            if imitation_learning:
-                # define the value of states in IL as cumulative discounted rewards, which is the same in RL
-                state = self.target_policy.transform(state)
-                # value = pow(self.gamma, (len(states) - 1 - i) * self.robot.time_step * self.robot.v_pref)
-                value = sum([pow(self.gamma, max(t - i, 0) * self.robot.time_step * self.robot.v_pref) * reward
-                             * (1 if t >= i else 0) for t, reward in enumerate(rewards)])
-            else:
-                if i == len(states) - 1:
-                    # terminal state
-                    value = reward
-                else:
-                    next_state = states[i + 1]
-                    gamma_bar = pow(self.gamma, self.robot.time_step * self.robot.v_pref)
-                    value = reward + gamma_bar * self.target_model(next_state.unsqueeze(0)).data.item()
-            value = torch.Tensor([value]).to(self.device)
-
-            # # transform state of different human_num into fixed-size tensor
-            # if len(state.size()) == 1:
-            #     human_num = 1
-            #     feature_size = state.size()[0]
-            # else:
-            #     human_num, feature_size = state.size()
-            # if human_num != 5:
-            #     padding = torch.zeros((5 - human_num, feature_size))
-            #     state = torch.cat([state, padding])
-            self.memory.push((state, value))
+        # VALUE UPDATE
+        if imitation_learning:
+            # define the value of states in IL as cumulative discounted rewards, which is the same in RL
+            states = [self.target_policy.transform(state) for state in states]
+            values = torch.Tensor(discounted_returns(rewards, self.discount())).to(self.device).unsqueeze(1)
+            # with lazy targets the returns are stored as rewards without a next state
+            discounts = torch.zeros_like(values)
+        else:
+            # the value of the terminal state is its reward, the other states are bootstrapped with the target
+            # model, which evaluates the next states of the whole episode in one forward pass
+            values = torch.Tensor(rewards).to(self.device).unsqueeze(1)
+            discounts = torch.full_like(values, self.discount())
+            discounts[-1] = 0
+            # with lazy targets the trainer bootstraps the sampled transitions instead
+            if len(states) > 1 and not self.memory.lazy_targets:
+                next_states, mask = pad_states(states[1:])
+                with torch.no_grad():
+                    values[:-1] += self.discount() * self.target_model(next_states, mask)
+
+        self.memory.push_batch(states, values, discounts)
 
     def increase_cl_level(self):
         return self.env.increase_cl_level()
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+from crowd_sim.envs.utils.state import FullState, ObservableState, JointState
+
+# bump when the layout of the saved arrays changes, so that old caches are not read
+CACHE_VERSION = 1
+
+
+def demonstration_key(env_config, il_policy, safety_space, il_episodes, train_config=None):
+    """
+    Demonstrations depend on the environment, the demonstrating policy and its safety space and the number of
+    episodes, but not on the trained policy: the cache holds the raw joint states and every policy transforms them
+    when they are loaded.
+
+    :param env_config: RawConfigParser of the environment
+    :param train_config: RawConfigParser of the training, only its curriculum section changes the environment
+    :return: hex digest identifying the demonstrations
+    """
+    config = {section: sorted(env_config.items(section)) for section in sorted(env_config.sections())}
+    if train_config is not None and train_config.has_section('curriculum'):
+        config['curriculum'] = sorted(train_config.items('curriculum'))
+    description = json.dumps({'version': CACHE_VERSION, 'env': config, 'il_policy': il_policy,
+                              'safety_space': safety_space, 'il_episodes': il_episodes}, sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def run_demonstrations(explorer, il_episodes, cache=None, key=None):
+    """
+    Fill the memory of the explorer with il_episodes demonstrations of the robot's current policy. Demonstrations
+    are loaded from the cache if it has the key and saved to it otherwise.
+    """
+    if cache is None:
+        explorer.run_k_episodes(il_episodes, 'train', update_memory=True, imitation_learning=True)
+        return
+    episodes = cache.load(key)
+    if episodes is None:
+        explorer.recorded_episodes = []
+        explorer.run_k_episodes(il_episodes, 'train', update_memory=True, imitation_learning=True)
+        cache.save(key, explorer.recorded_episodes)
+        explorer.recorded_episodes = None
+    else:
+        for states, rewards in episodes:
+            explorer.update_memory(states, None, rewards, imitation_learning=True)
+
+
+class DemonstrationCache(object):
+    def __init__(self, cache_dir):
+        """
+        Imitation learning demonstrations saved on disk as .npy files, one directory per key, which are mapped into
+        memory when loaded. Each state is stored as the robot's full state and the observable states of the humans
+        padded to the largest number of humans.
+        """
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def save(self, key, episodes):
+        """
+        :param episodes: list of (states, rewards) pairs, where states is the list of joint states of an episode
+        """
+        if not episodes:
+            return
+        states = [state for episode_states, _ in episodes for state in episode_states]
+        max_human_num = max(len(state.human_states) for state in states)
+        self_states = np.array([state.self_state + () for state in states])
+        human_states = np.zeros((len(states), max_human_num, 6))
+        human_nums = np.array([len(state.human_states) for state in states])
+        for i, state in enumerate(states):
+            human_states[i, :human_nums[i]] = [human_state + () for human_state in state.human_states]
+        arrays = {'self_states': self_states, 'human_states': human_states, 'human_nums': human_nums,
+                  'rewards': np.array([reward for _, rewards in episodes for reward in rewards]),
+                  'episode_lengths': np.array([len(episode_states) for episode_states, _ in episodes])}
+
+        # write to a temporary directory first, so that an interrupted run does not leave a partial cache
+        directory = self.path(key)
+        temp_directory = directory + '.tmp'
+        if os.path.exists(temp_directory):
+            shutil.rmtree(temp_directory)
+        os.makedirs(temp_directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_directory, name + '.npy'), array)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(temp_directory, directory)
+        logging.info('Saved %d demonstrations with %d states to %s', len(episodes), len(states), directory)
+
+    def load(self, key):
+        """
+        :return: list of (states, rewards) pairs in the order they were saved, None if there is no cache for the key
+        """
+        directory = self.path(key)
+        if not os.path.exists(directory):
+            return None
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                  for name in ['self_states', 'human_states', 'human_nums', 'rewards', 'episode_lengths']}
+        episodes = []
+        start = 0
+        for length in arrays['episode_lengths']:
+            end = start + int(length)
+            self_states = np.array(arrays['self_states'][start:end]).tolist()
+            human_states = np.array(arrays['human_states'][start:end]).tolist()
+            human_nums = np.array(arrays['human_nums'][start:end]).tolist()
+            states = [JointState(FullState(*self_state), [ObservableState(*human) for human in humans[:human_num]])
+                      for self_state, humans, human_num in zip(self_states, human_states, human_nums)]
+            episodes.append((states, np.array(arrays['rewards'][start:end]).tolist()))
+            start = end
+        logging.info('Loaded %d demonstrations with %d states from %s', len(episodes), start, directory)
+        return episodes
@@ -0,0 +1,87 @@
+import logging
+import torch
+import torch.multiprocessing as mp
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+from crowd_nav.utils.explorer import Explorer, summarize, log_summary
+
+# explorer of the worker process, built once by the pool initializer
+worker_explorer = None
+
+
+def init_worker(policy_name, policy_config_file, env_config_file, train_config_file, model_weights, precision,
+                quantize, policy_settings):
+    global worker_explorer
+    torch.set_num_threads(1)
+    device = torch.device('cpu')
+    policy = build_policy(policy_name, read_config(policy_config_file), device)
+    if policy.trainable:
+        policy.get_model().load_state_dict(torch.load(model_weights, map_location=device))
+        if precision is not None:
+            policy.precision = precision
+        if quantize:
+            policy.quantize()
+    for name, value in policy_settings.items():
+        setattr(policy, name, value)
+    train_config = read_config(train_config_file) if train_config_file is not None else None
+    env, robot = build_env(read_config(env_config_file), train_config)
+    robot.set_policy(policy)
+    policy.set_env(env)
+    worker_explorer = Explorer(env, robot, device, gamma=0.9)
+
+
+def run_cases(phase, cases, env_settings):
+    explorer = worker_explorer
+    for name, value in env_settings.items():
+        setattr(explorer.env, name, value)
+    explorer.robot.policy.set_phase(phase)
+    outcomes = []
+    for case in cases:
+        _, _, rewards, info, danger_dists = explorer.run_episode(phase, case)
+        outcomes.append(explorer.episode_outcome(case, info, rewards, danger_dists))
+    return outcomes
+
+
+class ParallelEvaluator(object):
+    def __init__(self, num_workers, policy_name, policy_config_file, env_config_file, train_config_file=None,
+                 model_weights=None, precision=None, quantize=False, policy_settings=None):
+        """
+        Run test or validation episodes in a pool of processes, each with its own simulator and copy of the policy on
+        the CPU. Every scenario is seeded by its case number, so a case gives the same episode in any process and the
+        merged outcomes are summarized exactly like the serial Explorer.run_k_episodes.
+
+        :param policy_settings: attributes set on the policy after it is configured, e.g. the safety space of ORCA
+        """
+        self.num_workers = num_workers
+        # spawn so that the workers do not inherit the CUDA context or the simulators of the parent
+        self.pool = mp.get_context('spawn').Pool(
+            num_workers, initializer=init_worker,
+            initargs=(policy_name, policy_config_file, env_config_file, train_config_file, model_weights, precision,
+                      quantize, policy_settings or {}))
+
+    def run_cases(self, phase, cases, env_settings=None):
+        """
+        :param cases: case numbers of the scenarios
+        :param env_settings: attributes set on the environment before the episodes, e.g. human_num
+        :return: outcomes of the cases in the order of cases
+        """
+        cases = list(cases)
+        # interleaved shards balance the cost of the cases between the workers
+        shards = [cases[i::self.num_workers] for i in range(self.num_workers)]
+        results = self.pool.starmap(run_cases, [(phase, shard, env_settings or {}) for shard in shards if shard])
+        outcomes = {outcome['case']: outcome for shard_outcomes in results for outcome in shard_outcomes}
+        return [outcomes[case] for case in cases]
+
+    def run_k_episodes(self, k, phase, time_limit, time_step, print_failure=False, env_settings=None):
+        """
+        Counterpart of Explorer.run_k_episodes for the cases 0 to k - 1
+
+        :return: summary of the episodes, see summarize
+        """
+        summary = summarize(self.run_cases(phase, range(k), env_settings), time_limit, time_step)
+        log_summary(phase, summary, print_failure=print_failure)
+        return summary
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        logging.debug('Evaluation workers stopped')
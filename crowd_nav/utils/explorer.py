@@ -1,7 +1,10 @@
 import logging
 import copy
+import numpy as np
 import torch
+from scipy.signal import lfilter
 from crowd_sim.envs.utils.info import *
+from crowd_nav.policy.cadrl import pad_states
 from tqdm import tqdm
 
 class Explorer(object):
@@ -13,122 +16,191 @@ class Explorer(object):
         self.gamma = gamma
         self.target_policy = target_policy
         self.target_model = None
+        # episodes added to the memory are also appended here when it is a list, e.g. to cache demonstrations
+        self.recorded_episodes = None
 
     def update_target_model(self, target_model):
         self.target_model = copy.deepcopy(target_model)
 
     # @profile
     def run_k_episodes(self, k, phase, update_memory=False, imitation_learning=False, episode=None,
-                       print_failure=False):
+                       print_failure=False, keep_timeouts=False):
+        """
+        :return: summary of the episodes, see summarize
+        """
         self.robot.policy.set_phase(phase)
-        success_times = []
-        collision_times = []
-        timeout_times = []
-        success = 0
-        collision = 0
-        timeout = 0
-        too_close = 0
-        min_dist = []
-        cumulative_rewards = []
-        collision_cases = []
-        timeout_cases = []
+        outcomes = []
         # for i in range(k):
         for i in tqdm(range(k)):
-            ob = self.env.reset(phase)
-            done = False
-            states = []
-            actions = []
-            rewards = []
-            while not done:
-                action = self.robot.act(ob)
-                ob, reward, done, info = self.env.step(action)
-                states.append(self.robot.policy.last_state)
-                actions.append(action)
-                rewards.append(reward)
-
-                if isinstance(info, Danger):
-                    too_close += 1
-                    min_dist.append(info.min_dist)
-
-            if isinstance(info, ReachGoal):
-                success += 1
-                success_times.append(self.env.global_time)
-            elif isinstance(info, Collision):
-                collision += 1
-                collision_cases.append(i)
-                collision_times.append(self.env.global_time)
-            elif isinstance(info, Timeout):
-                timeout += 1
-                timeout_cases.append(i)
-                timeout_times.append(self.env.time_limit)
-            elif isinstance(info, Boundary):
-                # dummy implementation, since current version is out of date
-                collision += 1
-                collision_cases.append(i)
-                collision_times.append(self.env.global_time)
-            else:
-                raise ValueError('Invalid end signal from environment')
+            states, actions, rewards, info, danger_dists = self.run_episode(phase)
+            outcomes.append(self.episode_outcome(i, info, rewards, danger_dists))
 
             if update_memory:
-                if isinstance(info, ReachGoal) or isinstance(info, Collision):
+                if isinstance(info, ReachGoal) or isinstance(info, Collision) or keep_timeouts:
                     # only add positive(success) or negative(collision) experience in experience set
+                    # unless the values are relabeled afterwards, e.g. for distillation
                     self.update_memory(states, actions, rewards, imitation_learning)
+                    if self.recorded_episodes is not None:
+                        self.recorded_episodes.append((states, rewards))
+
+        summary = summarize(outcomes, self.env.time_limit, self.robot.time_step)
+        log_summary(phase, summary, episode, print_failure)
+        return summary
+
+    def run_episode(self, phase, test_case=None):
+        """
+        :param test_case: case of the scenario, the next case of the phase if None
+        :return: states, actions and rewards of the episode, its end signal and the distances of the danger steps
+        """
+        ob = self.env.reset(phase, test_case)
+        done = False
+        states = []
+        actions = []
+        rewards = []
+        danger_dists = []
+        while not done:
+            action = self.robot.act(ob)
+            ob, reward, done, info = self.env.step(action)
+            states.append(self.robot.policy.last_state)
+            actions.append(action)
+            rewards.append(reward)
+
+            if isinstance(info, Danger):
+                danger_dists.append(info.min_dist)
+        return states, actions, rewards, info, danger_dists
+
+    def episode_outcome(self, case, info, rewards, danger_dists):
+        """
+        Everything summarize needs to know about an episode, so that episodes can be run anywhere and summarized later
+        """
+        if isinstance(info, ReachGoal):
+            result, time = 'success', self.env.global_time
+        elif isinstance(info, Collision):
+            result, time = 'collision', self.env.global_time
+        elif isinstance(info, Timeout):
+            result, time = 'timeout', self.env.time_limit
+        elif isinstance(info, Boundary):
+            # dummy implementation, since current version is out of date
+            result, time = 'collision', self.env.global_time
+        else:
+            raise ValueError('Invalid end signal from environment')
+        return {'case': case, 'result': result, 'time': time, 'danger_dists': danger_dists,
+                'cumulative_reward': discounted_returns(rewards, self.discount())[0]}
+
+    def add_episodes(self, episodes, episode=None):
+        """
+        Update the memory with training episodes collected by actor processes and log their statistics like
+        run_k_episodes does for the episodes it runs
+
+        :param episodes: list of (states, rewards, info, navigation time) tuples
+        """
+        success_times = []
+        collision = 0
+        cumulative_rewards = []
+        for states, rewards, info, nav_time in episodes:
+            if isinstance(info, ReachGoal):
+                success_times.append(nav_time)
+            elif isinstance(info, (Collision, Boundary)):
+                collision += 1
+            if isinstance(info, ReachGoal) or isinstance(info, Collision):
+                self.update_memory([state.to(self.device) for state in states], None, rewards)
+            cumulative_rewards.append(discounted_returns(rewards, self.discount())[0])
 
-            cumulative_rewards.append(sum([pow(self.gamma, t * self.robot.time_step * self.robot.v_pref)
-                                           * reward for t, reward in enumerate(rewards)]))
-
-        success_rate = success / k
-        collision_rate = collision / k
-        assert success + collision + timeout == k
         avg_nav_time = sum(success_times) / len(success_times) if success_times else self.env.time_limit
-
         extra_info = '' if episode is None else 'in episode {} '.format(episode)
         logging.info('{:<5} {}has success rate: {:.3f}, collision rate: {:.3f}, nav time: {:.3f}, total reward: {:.4f}'.
-                     format(phase.upper(), extra_info, success_rate, collision_rate, avg_nav_time,
-                            average(cumulative_rewards)))
-        if phase in ['val', 'test']:
-            num_step = sum(success_times + collision_times + timeout_times) / self.robot.time_step
-            logging.info('Frequency of being in danger: %.2f and average min separate distance in danger: %.2f',
-                         too_close / num_step, average(min_dist))
+                     format('TRAIN', extra_info, len(success_times) / len(episodes), collision / len(episodes),
+                            avg_nav_time, average(cumulative_rewards)))
 
-        if print_failure:
-            logging.info('Collision cases: ' + ' '.join([str(x) for x in collision_cases]))
-            logging.info('Timeout cases: ' + ' '.join([str(x) for x in timeout_cases]))
+    def discount(self):
+        """
+        Discount factor of one time step, gamma is defined per unit of time and preferred speed
+        """
+        return pow(self.gamma, self.env.time_step * self.robot.v_pref)
 
     def update_memory(self, states, actions, rewards, imitation_learning=False):
         if self.memory is None or self.gamma is None:
             raise ValueError('Memory or gamma value is not set!')
 
-        for i, state in enumerate(states):
-            reward = rewards[i]
-
-            # VALUE UPDATE
-            if imitation_learning:
-                # define the value of states in IL as cumulative discounted rewards, which is the same in RL
-                state = self.target_policy.transform(state)
-                # value = pow(self.gamma, (len(states) - 1 - i) * self.robot.time_step * self.robot.v_pref)
-                value = sum([pow(self.gamma, max(t - i, 0) * self.robot.time_step * self.robot.v_pref) * reward
-                             * (1 if t >= i else 0) for t, reward in enumerate(rewards)])
-            else:
-                if i == len(states) - 1:
-                    # terminal state
-                    value = reward
-                else:
-                    next_state = states[i + 1]
-                    gamma_bar = pow(self.gamma, self.robot.time_step * self.robot.v_pref)
-                    value = reward + gamma_bar * self.target_model(next_state.unsqueeze(0)).data.item()
-            value = torch.Tensor([value]).to(self.device)
-
-            # # transform state of different human_num into fixed-size tensor
-            # if len(state.size()) == 1:
-            #     human_num = 1
-            #     feature_size = state.size()[0]
-            # else:
-            #     human_num, feature_size = state.size()
-            # if human_num != 5:
-            #     padding = torch.zeros((5 - human_num, feature_size))
-            #     state = torch.cat([state, padding])
-            self.memory.push((state, value))
+        # VALUE UPDATE
+        if imitation_learning:
+            # define the value of states in IL as cumulative discounted rewards, which is the same in RL
+            states = [self.target_policy.transform(state) for state in states]
+            values = torch.Tensor(discounted_returns(rewards, self.discount())).to(self.device).unsqueeze(1)
+            # with lazy targets the returns are stored as rewards without a next state
+            discounts = torch.zeros_like(values)
+        else:
+            # the value of the terminal state is its reward, the other states are bootstrapped with the target
+            # model, which evaluates the next states of the whole episode in one forward pass
+            values = torch.Tensor(rewards).to(self.device).unsqueeze(1)
+            discounts = torch.full_like(values, self.discount())
+            discounts[-1] = 0
+            # with lazy targets the trainer bootstraps the sampled transitions instead
+            if len(states) > 1 and not self.memory.lazy_targets:
+                next_states, mask = pad_states(states[1:])
+                with torch.no_grad():
+                    values[:-1] += self.discount() * self.target_model(next_states, mask)
+
+        self.memory.push_batch(states, values, discounts)
+
+
+def summarize(outcomes, time_limit, time_step):
+    """
+    Aggregate episode outcomes in the order they are given
+
+    :param outcomes: list of dicts returned by Explorer.episode_outcome
+    :return: dict of the rates, the average navigation time of the successes, the average discounted return, the
+    frequency of being in danger, the average distance in danger and the cases that collided or timed out
+    """
+    k = len(outcomes)
+    success_times = [outcome['time'] for outcome in outcomes if outcome['result'] == 'success']
+    collision_times = [outcome['time'] for outcome in outcomes if outcome['result'] == 'collision']
+    timeout_times = [outcome['time'] for outcome in outcomes if outcome['result'] == 'timeout']
+    assert len(success_times) + len(collision_times) + len(timeout_times) == k
+    min_dist = [dist for outcome in outcomes for dist in outcome['danger_dists']]
+    num_step = sum(success_times + collision_times + timeout_times) / time_step
+    return {'success_rate': len(success_times) / k,
+            'collision_rate': len(collision_times) / k,
+            'timeout_rate': len(timeout_times) / k,
+            'nav_time': sum(success_times) / len(success_times) if success_times else time_limit,
+            'total_reward': average([outcome['cumulative_reward'] for outcome in outcomes]),
+            'danger_frequency': len(min_dist) / num_step if num_step else 0,
+            'min_dist': average(min_dist),
+            'collision_cases': [outcome['case'] for outcome in outcomes if outcome['result'] == 'collision'],
+            'timeout_cases': [outcome['case'] for outcome in outcomes if outcome['result'] == 'timeout']}
+
+
+def log_summary(phase, summary, episode=None, print_failure=False):
+    extra_info = '' if episode is None else 'in episode {} '.format(episode)
+    logging.info('{:<5} {}has success rate: {:.3f}, collision rate: {:.3f}, nav time: {:.3f}, total reward: {:.4f}'.
+                 format(phase.upper(), extra_info, summary['success_rate'], summary['collision_rate'],
+                        summary['nav_time'], summary['total_reward']))
+    if phase in ['val', 'test']:
+        logging.info('Frequency of being in danger: %.2f and average min separate distance in danger: %.2f',
+                     summary['danger_frequency'], summary['min_dist'])
+
+    if print_failure:
+        logging.info('Collision cases: ' + ' '.join([str(x) for x in summary['collision_cases']]))
+        logging.info('Timeout cases: ' + ' '.join([str(x) for x in summary['timeout_cases']]))
+
+
+def discounted_returns(rewards, discount):
+    """
+    Discounted return from every step of an episode to its end,
+    returns[i] = sum of discount ** (t - i) * rewards[t] for t >= i
+
+    The recursion returns[i] = rewards[i] + discount * returns[i + 1] is a first-order IIR filter run over the reversed
+    rewards, which lfilter computes in C instead of a Python loop over the steps.
+
+    :param rewards: rewards of the episode
+    :param discount: discount factor of one step
+    :return: array of the same length as rewards
+    """
+    rewards = np.asarray(rewards, dtype=float)
+    if len(rewards) == 0:
+        return rewards
+    # copied into a contiguous array, torch does not take arrays with negative strides
+    return np.ascontiguousarray(lfilter([1], [1, -discount], rewards[::-1])[::-1])
 
 
 def average(input_list):
@@ -1,28 +1,366 @@
+import json
+import os
+import shutil
+import numpy as np
+import torch
 from torch.utils.data import Dataset
+from crowd_nav.policy.cadrl import pad_states
 
 
 class ReplayMemory(Dataset):
-    def __init__(self, capacity):
+    def __init__(self, capacity, lazy_targets=False):
+        """
+        Ring buffer of (state, value) pairs backed by preallocated tensors. States of shape (# of agents, D) are
+        zero-padded to the largest number of agents seen so far and their number of agents is kept in lengths,
+        states of shape (D,) from single-agent policies are stored as they are.
+        The storage is allocated at the first push, on the device of the pushed tensors.
+
+        With lazy_targets the memory stores transitions instead of value targets: values holds the rewards and
+        discounts the discount of the next state's value, 0 for the last state of an episode. Episodes are pushed
+        as a whole, so the next state of a transition is the following entry of the ring buffer and is not stored
+        twice, see next_indices.
+        """
         self.capacity = capacity
-        self.memory = list()
+        self.lazy_targets = lazy_targets
+        self.states = None
+        self.values = None
+        self.discounts = None
+        self.lengths = None
         self.position = 0
+        self.size = 0
+
+    def allocate(self, state_shape, device):
+        self.states = torch.zeros((self.capacity,) + tuple(state_shape), device=device)
+        self.values = torch.zeros(self.capacity, 1, device=device)
+        if self.lazy_targets:
+            self.discounts = torch.zeros(self.capacity, 1, device=device)
+        self.lengths = torch.zeros(self.capacity, dtype=torch.long, device=device) if len(state_shape) == 2 else None
+
+    def grow(self, agent_num):
+        """
+        Widen the agent dimension of the storage when a state has more agents than any state before
+        """
+        states = torch.zeros(self.capacity, agent_num, self.states.shape[2], device=self.states.device)
+        states[:, :self.states.shape[1]] = self.states
+        self.states = states
 
     def push(self, item):
-        # replace old experience with new experience
-        if len(self.memory) < self.position + 1:
-            self.memory.append(item)
+        state, value = item
+        self.push_batch([state], value.view(1, 1))
+
+    def push_batch(self, states, values, discounts=None):
+        """
+        Insert the states of a whole episode at once, replacing the oldest experience when the memory is full
+
+        :param states: list of state tensors
+        :param values: tensor of shape (len(states), 1), the rewards with lazy targets
+        :param discounts: tensor of shape (len(states), 1), only stored with lazy targets
+        """
+        if self.lazy_targets and discounts is None:
+            raise ValueError('Discounts are required to store transitions with lazy targets')
+        if len(states) > self.capacity:
+            states = states[-self.capacity:]
+            values = values[-self.capacity:]
+            if discounts is not None:
+                discounts = discounts[-self.capacity:]
+        if self.states is None:
+            self.allocate(states[0].shape, states[0].device)
+        batch_size = len(states)
+        indices = (self.position + torch.arange(batch_size, device=self.states.device)) % self.capacity
+        if self.lengths is None:
+            self.states[indices] = torch.stack(states).to(self.states.device)
         else:
-            self.memory[self.position] = item
-        self.position = (self.position + 1) % self.capacity
+            lengths = torch.tensor([state.shape[0] for state in states], device=self.states.device)
+            agent_num = int(lengths.max())
+            if agent_num > self.states.shape[1]:
+                self.grow(agent_num)
+            padded_states = torch.zeros(batch_size, self.states.shape[1], self.states.shape[2],
+                                        device=self.states.device)
+            padded_states[:, :agent_num] = pad_states(states)[0]
+            self.states[indices] = padded_states
+            self.lengths[indices] = lengths
+        self.values[indices] = values.to(self.values.device).view(-1, 1)
+        if self.lazy_targets:
+            self.discounts[indices] = discounts.to(self.discounts.device).view(-1, 1)
+        self.position = (self.position + batch_size) % self.capacity
+        self.size = min(self.size + batch_size, self.capacity)
+
+    def sample(self, indices):
+        """
+        Gather a batch with one index operation per tensor
+
+        :param indices: long tensor of indices smaller than len(self)
+        :return: states padded to the largest number of agents in the batch, values and the validity mask of the
+        states (None if nothing was padded), the same as pad_collate
+        """
+        indices = torch.as_tensor(indices, device=self.states.device)
+        values = self.values[indices]
+        if self.lengths is None:
+            return self.states[indices], values, None
+        lengths = self.lengths[indices]
+        max_length = int(lengths.max())
+        states = self.states[indices, :max_length]
+        if int(lengths.min()) == max_length:
+            return states, values, None
+        mask = torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+        return states, values, mask
+
+    def next_indices(self, indices):
+        """
+        Indices of the next states of the transitions at indices, only valid for transitions with a nonzero discount.
+        The ring buffer is overwritten in order, so the next state of a transition is overwritten only after the
+        transition itself, except for the last transition of an episode, whose discount is 0.
+        """
+        return (torch.as_tensor(indices, device=self.states.device) + 1) % self.capacity
 
     def is_full(self):
-        return len(self.memory) == self.capacity
+        return self.size == self.capacity
 
     def __getitem__(self, item):
-        return self.memory[item]
+        if self.lengths is None:
+            return self.states[item], self.values[item]
+        return self.states[item, :self.lengths[item]], self.values[item]
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
+
+    def clear(self):
+        self.position = 0
+        self.size = 0
+
+    def storage(self):
+        """
+        :return: dict of the storage tensors that are saved with the memory
+        """
+        tensors = {'states': self.states, 'values': self.values, 'lengths': self.lengths, 'discounts': self.discounts}
+        return {name: tensor for name, tensor in tensors.items() if tensor is not None}
+
+    def saved_arrays(self):
+        return {name: tensor[:self.size].cpu().numpy() for name, tensor in self.storage().items()}
+
+    def metadata(self):
+        return {'capacity': self.capacity, 'lazy_targets': self.lazy_targets, 'position': self.position,
+                'size': self.size}
+
+    def save(self, directory):
+        """
+        Save the filled part of the storage as one .npy file per tensor, which load maps into memory instead of
+        reading it at once. The directory is replaced only after all files are written.
+        """
+        if self.states is None:
+            return
+        temp_directory = directory.rstrip(os.sep) + '.tmp'
+        if os.path.exists(temp_directory):
+            shutil.rmtree(temp_directory)
+        os.makedirs(temp_directory)
+        for name, array in self.saved_arrays().items():
+            np.save(os.path.join(temp_directory, name + '.npy'), array)
+        with open(os.path.join(temp_directory, 'metadata.json'), 'w') as metadata_file:
+            json.dump(self.metadata(), metadata_file)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(temp_directory, directory)
+
+    def load(self, directory, device=None, chunk_size=10000):
+        """
+        Restore a memory saved with save, the saved memory must have the same capacity and kind of targets
+
+        :param device: device of the storage, the device of the current storage or cpu if None
+        :param chunk_size: number of entries copied from the memory-mapped files at a time
+        """
+        with open(os.path.join(directory, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata['capacity'] != self.capacity or metadata['lazy_targets'] != self.lazy_targets:
+            raise ValueError('Replay memory in {} has capacity {} and lazy targets {}, expected {} and {}'.format(
+                directory, metadata['capacity'], metadata['lazy_targets'], self.capacity, self.lazy_targets))
+        if device is None:
+            device = self.states.device if self.states is not None else torch.device('cpu')
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                  for name in ['states', 'values', 'lengths', 'discounts']
+                  if os.path.exists(os.path.join(directory, name + '.npy'))}
+        self.allocate(arrays['states'].shape[1:], device)
+        for name, tensor in self.storage().items():
+            array = arrays[name]
+            for start in range(0, len(array), chunk_size):
+                # copy the chunk out of the memory-mapped file, the last chunk may be shorter than chunk_size
+                chunk = np.array(array[start:start + chunk_size])
+                tensor[start:start + len(chunk)] = torch.from_numpy(chunk)
+        self.position = metadata['position']
+        self.size = metadata['size']
+        return metadata
+
+
+class SumTree(object):
+    def __init__(self, capacity):
+        """
+        Binary tree in an array whose leaves are the priorities of the memory entries and whose inner nodes are the
+        sums of their children, node i has the children 2i and 2i + 1 and the root is node 1. The number of leaves is
+        the capacity rounded up to a power of two, so that all leaves are at the same depth.
+        """
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.num_leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of the leaves at indices and update their ancestors level by level, O(log n) per leaf
+        """
+        nodes = np.asarray(indices) + self.num_leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, prefix_sums):
+        """
+        Descend from the root to the leaves whose cumulative priority ranges contain prefix_sums, O(log n) per value
+
+        :param prefix_sums: array of values in [0, total)
+        :return: array of leaf indices
+        """
+        prefix_sums = np.array(prefix_sums, dtype=float)
+        nodes = np.ones(len(prefix_sums), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = prefix_sums >= self.tree[left]
+            prefix_sums -= np.where(right, self.tree[left], 0)
+            nodes = left + right
+        return nodes - self.num_leaves
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.num_leaves]
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, capacity, lazy_targets=False, alpha=0.6, beta=0.4, epsilon=1e-3):
+        """
+        Replay memory whose entries are sampled with probability proportional to priority ** alpha, where the priority
+        of an entry is the absolute TD error of its last update. New entries get the largest priority so far, so that
+        they are sampled at least once.
+
+        :param alpha: how much the priorities skew the sampling, 0 for uniform sampling
+        :param beta: exponent of the importance-sampling weights correcting the skew, annealed to 1 during training
+        :param epsilon: added to the TD errors so that no entry has zero probability
+        """
+        super().__init__(capacity, lazy_targets)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def push_batch(self, states, values, discounts=None):
+        batch_size = min(len(states), self.capacity)
+        indices = (self.position + np.arange(batch_size)) % self.capacity
+        super().push_batch(states, values, discounts)
+        self.tree.update(indices, self.max_priority ** self.alpha)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype=float)).reshape(-1) + self.epsilon
+        self.tree.update(np.asarray(indices), priorities ** self.alpha)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
+    def importance_weights(self, indices):
+        """
+        Importance-sampling weights (N * P(i)) ** -beta of the entries at indices, normalized by the largest weight
+        of the batch so that the updates are only scaled down
+        """
+        probabilities = self.tree[np.asarray(indices)] / self.tree.total()
+        weights = (len(self) * probabilities) ** -self.beta
+        return torch.tensor(weights / weights.max(), dtype=torch.float, device=self.values.device).unsqueeze(1)
 
     def clear(self):
-        self.memory = list()
+        super().clear()
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+    def metadata(self):
+        metadata = super().metadata()
+        metadata['max_priority'] = self.max_priority
+        return metadata
+
+    def saved_arrays(self):
+        arrays = super().saved_arrays()
+        arrays['priorities'] = self.tree[np.arange(self.size)]
+        return arrays
+
+    def load(self, directory, device=None, chunk_size=10000):
+        """
+        Restore the priorities with the memory, a memory saved without priorities gets the largest saved priority
+        """
+        metadata = super().load(directory, device, chunk_size)
+        self.tree = SumTree(self.capacity)
+        self.max_priority = metadata.get('max_priority', 1.0)
+        priorities_file = os.path.join(directory, 'priorities.npy')
+        if os.path.exists(priorities_file):
+            self.tree.update(np.arange(self.size), np.load(priorities_file))
+        else:
+            self.tree.update(np.arange(self.size), self.max_priority ** self.alpha)
+        return metadata
+
+
+class MiniBatchSampler(object):
+    def __init__(self, memory, batch_size, replacement=False, seed=None):
+        """
+        Draw random mini-batches from a ReplayMemory by index, without building a permutation of the whole memory
+
+        :param replacement: whether the indices of one batch are drawn with replacement
+        :param seed: seed of the random generator, batches are reproducible for the same seed and memory
+        """
+        self.memory = memory
+        self.batch_size = batch_size
+        self.replacement = replacement
+        self.rng = np.random.default_rng(seed)
+
+    def draw(self):
+        """
+        :return: long tensor with the indices of one batch
+        """
+        size = len(self.memory)
+        batch_size = self.batch_size if self.replacement else min(self.batch_size, size)
+        return torch.from_numpy(self.rng.choice(size, batch_size, replace=self.replacement))
+
+    def sample(self):
+        """
+        :return: one batch in the layout of ReplayMemory.sample
+        """
+        return self.memory.sample(self.draw())
+
+    def epoch(self):
+        """
+        Iterate over the indices of the whole memory once in random order
+        """
+        permutation = torch.from_numpy(self.rng.permutation(len(self.memory)))
+        for start in range(0, len(permutation), self.batch_size):
+            yield permutation[start:start + self.batch_size]
+
+
+class PrioritizedSampler(MiniBatchSampler):
+    def __init__(self, memory, batch_size, seed=None):
+        """
+        Draw mini-batches from a PrioritizedReplayMemory in proportion to the priorities, always with replacement.
+        The total priority is split into batch_size equal segments and one entry is drawn from each segment.
+        Epochs still iterate over the whole memory uniformly.
+        """
+        super().__init__(memory, batch_size, replacement=True, seed=seed)
+
+    def draw(self):
+        segment = self.memory.tree.total() / self.batch_size
+        prefix_sums = (np.arange(self.batch_size) + self.rng.random(self.batch_size)) * segment
+        indices = np.minimum(self.memory.tree.find(prefix_sums), len(self.memory) - 1)
+        return torch.from_numpy(indices)
+
+
+def pad_collate(batch):
+    """
+    Collate function for DataLoader that pads states with different numbers of humans to the batch maximum
+
+    :param batch: list of (state, value) pairs
+    :return: padded states, values and the validity mask of the padded states (None if nothing was padded)
+    """
+    states, values = zip(*batch)
+    states, mask = pad_states(list(states))
+    return states, torch.stack(values), mask
@@ -1,43 +1,82 @@
 import logging
+import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
+from crowd_nav.utils.memory import MiniBatchSampler, PrioritizedReplayMemory, PrioritizedSampler
 
 
 class Trainer(object):
-    def __init__(self, model, memory, device, batch_size):
+    def __init__(self, model, memory, device, batch_size, precision='float32', replacement=False, seed=None):
         """
         Train the trainable model of a policy
+
+        :param precision: float32, or bfloat16 to compute the forward pass with autocast
+        :param replacement: whether mini-batches are sampled with replacement, always with a prioritized memory
+        :param seed: seed of the mini-batch sampler
         """
         self.model = model
         self.device = device
         self.criterion = nn.MSELoss().to(device)
         self.memory = memory
-        self.data_loader = None
+        self.prioritized = isinstance(memory, PrioritizedReplayMemory)
+        if self.prioritized:
+            self.sampler = PrioritizedSampler(memory, batch_size, seed)
+        else:
+            self.sampler = MiniBatchSampler(memory, batch_size, replacement, seed)
         self.batch_size = batch_size
         self.optimizer = None
+        # only used for the targets of a memory with lazy targets
+        self.target_model = None
+        self.precision = precision
 
     def set_learning_rate(self, learning_rate):
         logging.info('Current learning rate: %f', learning_rate)
         self.optimizer = optim.SGD(self.model.parameters(), lr=learning_rate, momentum=0.9)
 
+    def set_target_model(self, target_model):
+        self.target_model = target_model
+
+    def sample(self, indices):
+        """
+        Gather a batch from the memory, with lazy targets the value of a state is computed here from its reward and
+        the target model's value of its next state, with the target model at the time the batch is sampled
+
+        :return: states, value targets and the validity mask of the states
+        """
+        inputs, values, mask = self.memory.sample(indices)
+        if not self.memory.lazy_targets:
+            return inputs, values, mask
+        discounts = self.memory.discounts[indices]
+        bootstrapped = torch.nonzero(discounts.squeeze(1)).squeeze(1)
+        if len(bootstrapped) > 0:
+            if self.target_model is None:
+                raise ValueError('Target model is not set!')
+            next_states, _, next_mask = self.memory.sample(self.memory.next_indices(indices[bootstrapped.cpu()]))
+            values = values.clone()
+            with torch.no_grad():
+                values[bootstrapped] += discounts[bootstrapped] * self.target_model(next_states, next_mask)
+        return inputs, values, mask
+
+    def autocast(self):
+        # weights and gradients stay in float32, the loss is computed in float32 from the upcast outputs
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bfloat16')
+
     def optimize_epoch(self, num_epochs):
         if self.optimizer is None:
             raise ValueError('Learning rate is not set!')
-        if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
         average_epoch_loss = 0
         for epoch in range(num_epochs):
             epoch_loss = 0
-            for data in self.data_loader:
-                inputs, values = data
+            for indices in self.sampler.epoch():
+                inputs, values, mask = self.sample(indices)
                 inputs = Variable(inputs)
                 values = Variable(values)
 
                 self.optimizer.zero_grad()
-                outputs = self.model(inputs)
-                loss = self.criterion(outputs, values)
+                with self.autocast():
+                    outputs = self.model(inputs, mask)
+                loss = self.criterion(outputs.float(), values)
                 loss.backward()
                 self.optimizer.step()
                 epoch_loss += loss.data.item()
@@ -50,17 +89,23 @@ class Trainer(object):
     def optimize_batch(self, num_batches):
         if self.optimizer is None:
             raise ValueError('Learning rate is not set!')
-        if self.data_loader is None:
-            self.data_loader = DataLoader(self.memory, self.batch_size, shuffle=True)
         losses = 0
         for _ in range(num_batches):
-            inputs, values = next(iter(self.data_loader))
+            indices = self.sampler.draw()
+            inputs, values, mask = self.sample(indices)
             inputs = Variable(inputs)
             values = Variable(values)
 
             self.optimizer.zero_grad()
-            outputs = self.model(inputs)
-            loss = self.criterion(outputs, values)
+            with self.autocast():
+                outputs = self.model(inputs, mask)
+            if self.prioritized:
+                # the importance-sampling weights correct the bias of sampling by TD error
+                td_errors = outputs.float() - values
+                loss = (self.memory.importance_weights(indices) * td_errors.pow(2)).mean()
+                self.memory.update_priorities(indices.numpy(), td_errors.detach().cpu().numpy())
+            else:
+                loss = self.criterion(outputs.float(), values)
             loss.backward()
             self.optimizer.step()
             losses += loss.data.item()
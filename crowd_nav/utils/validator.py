@@ -0,0 +1,99 @@
+import logging
+import queue
+import sys
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+from crowd_nav.utils.explorer import Explorer
+
+
+def run_validator(policy_name, policy_config_file, env_config_file, train_config_file, best_weight_file, log_file,
+                  jobs, results):
+    """
+    Validate the weight snapshots from jobs until None is received. The environment of the validator is configured
+    with the curriculum of the training config, validation scenarios are always on the hardest level.
+    """
+    logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler(sys.stdout), logging.FileHandler(log_file)],
+                        format='%(asctime)s, %(levelname)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+    torch.set_num_threads(1)
+    device = torch.device('cpu')
+    policy = build_policy(policy_name, read_config(policy_config_file), device)
+    env, robot = build_env(read_config(env_config_file), read_config(train_config_file))
+    policy.set_env(env)
+    robot.set_policy(policy)
+    explorer = Explorer(env, robot, device, gamma=policy.gamma)
+    best_success_rate = -1
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        episode, state_dict = job
+        policy.get_model().load_state_dict(state_dict)
+        # the validation cases start from the first case and the same random state for every snapshot, so that the
+        # results of the snapshots do not depend on the randomness used by the snapshots before them
+        env.case_counter['val'] = 0
+        torch.manual_seed(0)
+        np.random.seed(0)
+        success_rate = explorer.run_k_episodes(env.case_size['val'], 'val', episode=episode)['success_rate']
+        if success_rate > best_success_rate:
+            best_success_rate = success_rate
+            torch.save(state_dict, best_weight_file)
+            logging.info('Best validation success rate %.3f in episode %d, weights saved to %s', success_rate, episode,
+                         best_weight_file)
+        results.put((episode, success_rate))
+
+
+class BackgroundValidator(object):
+    def __init__(self, policy_name, policy_config_file, env_config_file, train_config_file, best_weight_file,
+                 log_file):
+        """
+        Run the validation episodes in a separate process on snapshots of the weights, so that training continues
+        while a snapshot is validated. The validation of a snapshot is logged with the episode it was taken at and the
+        weights with the best validation success rate so far are saved to best_weight_file.
+        """
+        context = mp.get_context('spawn')
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.pending = 0
+        self.process = context.Process(target=run_validator, name='validator', daemon=True,
+                                       args=(policy_name, policy_config_file, env_config_file, train_config_file,
+                                             best_weight_file, log_file, self.jobs, self.results))
+        self.process.start()
+
+    def submit(self, model, episode):
+        """
+        Validate a snapshot of the current weights, skipped if the previous snapshot is still waiting to be validated
+        """
+        self.poll()
+        if self.pending > 1:
+            logging.info('Skip validation in episode %d, the validator is still busy', episode)
+            return
+        if not self.process.is_alive():
+            logging.error('Validator has stopped, skip validation in episode %d', episode)
+            return
+        state_dict = {name: tensor.detach().cpu().clone() for name, tensor in model.state_dict().items()}
+        self.jobs.put((episode, state_dict))
+        self.pending += 1
+
+    def poll(self):
+        """
+        :return: list of (episode, success rate) of the snapshots validated since the last call
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.pending -= len(results)
+        return results
+
+    def close(self):
+        """
+        Wait for the pending validations to finish
+        """
+        self.jobs.put(None)
+        self.process.join()
+        return self.poll()
@@ -1,6 +1,5 @@
 from curses import nonl
 import logging
-from crowd_nav.policy.gat4sn import GAT4SN
 import gym
 import matplotlib.lines as mlines
 import numpy as np
@@ -541,8 +540,10 @@ class CrowdSim(gym.Env):
         self.states = list()
         if hasattr(self.robot.policy, 'action_values'):
             self.action_values = list()
-        if hasattr(self.robot.policy, 'get_attention_weights'):
+        if getattr(self.robot.policy, 'capture_attention', False):
             self.attention_weights = list()
+        else:
+            self.attention_weights = None
 
         # get current observation
         self.observable_states = list()
@@ -794,7 +795,7 @@ class CrowdSim(gym.Env):
             self.states.append([self.robot.get_full_state(), [human.get_full_state() for human in self.humans], [obstacle.get_full_state() for obstacle in self.obs]])
             if hasattr(self.robot.policy, 'action_values'):
                 self.action_values.append(self.robot.policy.action_values)
-            if hasattr(self.robot.policy, 'get_attention_weights'):
+            if getattr(self.robot.policy, 'capture_attention', False):
                 self.attention_weights.append(self.robot.policy.get_attention_weights())
             # store observable states
             self.observable_states.append([human.get_observable_state() for human in self.humans])
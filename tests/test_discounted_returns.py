@@ -0,0 +1,31 @@
+import numpy as np
+from crowd_nav.utils.explorer import discounted_returns
+
+
+def reference_returns(rewards, gamma, time_step, v_pref):
+    # per-state value of imitation learning targets before the reverse-pass kernel
+    return [sum([pow(gamma, max(t - i, 0) * time_step * v_pref) * reward * (1 if t >= i else 0)
+                 for t, reward in enumerate(rewards)]) for i in range(len(rewards))]
+
+
+def test_discounted_returns_match_per_state_sums():
+    rng = np.random.default_rng(0)
+    for gamma, time_step, v_pref in [(0.9, 0.25, 1), (0.95, 0.1, 1.5), (0.99, 0.25, 0.5)]:
+        for length in [1, 2, 17, 140]:
+            rewards = list(rng.uniform(-0.25, 1, length))
+            returns = discounted_returns(rewards, pow(gamma, time_step * v_pref))
+            np.testing.assert_allclose(returns, reference_returns(rewards, gamma, time_step, v_pref),
+                                       rtol=1e-12, atol=1e-15)
+
+
+def test_first_return_is_cumulative_reward():
+    gamma, time_step, v_pref = 0.9, 0.25, 1
+    rewards = [0, -0.01, -0.005, 0, 0, 1]
+    cumulative_reward = sum([pow(gamma, t * time_step * v_pref) * reward for t, reward in enumerate(rewards)])
+    assert abs(discounted_returns(rewards, pow(gamma, time_step * v_pref))[0] - cumulative_reward) < 1e-15
+
+
+def test_sparse_terminal_rewards():
+    # typical episodes: zero rewards until the terminal collision or success reward
+    returns = discounted_returns([0] * 4 + [-0.25], 0.5)
+    np.testing.assert_allclose(returns, [-0.25 / 16, -0.25 / 8, -0.25 / 4, -0.25 / 2, -0.25], rtol=0, atol=0)
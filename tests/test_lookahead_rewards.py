@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import torch
+from crowd_sim.envs.utils.info import Collision
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'crowd_nav', 'configs')
+
+
+def build_boundary_case(px, py, gx, gy):
+    """
+    The robot alone next to the boundary, so that both lookaheads only differ in how they treat the boundary
+    """
+    device = torch.device('cpu')
+    policy = build_policy('sarl', read_config(os.path.join(CONFIG_DIR, 'policy.config')), device)
+    env, robot = build_env(read_config(os.path.join(CONFIG_DIR, 'env.config')),
+                           read_config(os.path.join(CONFIG_DIR, 'train.config')))
+    robot.set_policy(policy)
+    policy.set_env(env)
+    policy.set_phase('test')
+    policy.time_step = env.time_step
+    env.reset('test', 0)
+    env.humans = []
+    env.obs = []
+    robot.set(px, py, gx, gy, 0, 0, np.pi / 2)
+    policy.build_action_space(robot.v_pref)
+    return env, robot, policy
+
+
+def compare_lookaheads(env, robot, policy):
+    next_self_states = policy.propagate_batch(robot.get_full_state())
+    rewards, collisions = policy.compute_rewards(next_self_states, torch.zeros(0, 5))
+    env_rewards = []
+    env_collisions = []
+    for action in policy.action_space:
+        _, reward, done, info = env.onestep_lookahead(action)
+        env_rewards.append(reward)
+        env_collisions.append(done and isinstance(info, Collision))
+    np.testing.assert_allclose(rewards, env_rewards, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(collisions, env_collisions)
+    return collisions
+
+
+def test_lookaheads_agree_at_the_boundary():
+    env, robot, policy = build_boundary_case(0, 0, 0, 0)
+    edge = env.boundary / 2 - robot.radius - 0.05
+    for px, py in [(edge, 0), (-edge, 0), (0, edge), (0, -edge), (edge, edge)]:
+        robot.set(px, py, -px, -py, 0, 0, np.pi / 2)
+        collisions = compare_lookaheads(env, robot, policy)
+        # some actions leave the area and are pruned, others stay inside
+        assert collisions.any() and not collisions.all()
+
+
+def test_lookaheads_agree_inside_the_area():
+    env, robot, policy = build_boundary_case(0, 0, 0, 0)
+    robot.set(0, 0, 0, 4, 0, 0, np.pi / 2)
+    assert not compare_lookaheads(env, robot, policy).any()
@@ -0,0 +1,69 @@
+import os
+import torch
+from crowd_nav.utils.builder import read_config, build_policy, build_env
+from crowd_nav.utils.explorer import Explorer, summarize
+from crowd_nav.utils.evaluator import ParallelEvaluator
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'crowd_nav', 'configs')
+# ORCA is deterministic and needs no weights, in this scene its episodes end in successes, collisions and timeouts
+POLICY = 'orca'
+NUM_CASES = 12
+SAFETY_SPACE = 0.15
+
+
+def write_configs(tmp_path):
+    env_config = read_config(os.path.join(CONFIG_DIR, 'env.config'))
+    env_config.set('env', 'test_size', str(NUM_CASES))
+    # the longest episodes run into the time limit
+    env_config.set('env', 'time_limit', '10')
+    env_config.set('sim', 'human_num', '5')
+    # placing the static obstacles takes very long in some cases
+    env_config.set('sim', 'static_obstacle_num', '0')
+    env_config_file = str(tmp_path / 'env.config')
+    with open(env_config_file, 'w') as config_file:
+        env_config.write(config_file)
+    policy_config_file = os.path.join(CONFIG_DIR, 'policy.config')
+    train_config_file = os.path.join(CONFIG_DIR, 'train.config')
+    return env_config_file, policy_config_file, train_config_file
+
+
+def run_serial(env_config_file, policy_config_file, train_config_file):
+    device = torch.device('cpu')
+    policy = build_policy(POLICY, read_config(policy_config_file), device)
+    policy.safety_space = SAFETY_SPACE
+    env, robot = build_env(read_config(env_config_file), read_config(train_config_file))
+    robot.set_policy(policy)
+    policy.set_env(env)
+    explorer = Explorer(env, robot, device, gamma=0.9)
+    policy.set_phase('test')
+    outcomes = []
+    for case in range(NUM_CASES):
+        _, _, rewards, info, danger_dists = explorer.run_episode('test', case)
+        outcomes.append(explorer.episode_outcome(case, info, rewards, danger_dists))
+    env.case_counter['test'] = 0
+    summary = explorer.run_k_episodes(env.case_size['test'], 'test', print_failure=True)
+    return outcomes, summary, env
+
+
+def test_parallel_evaluation_is_identical_to_serial(tmp_path):
+    config_files = write_configs(tmp_path)
+    serial_outcomes, serial_summary, env = run_serial(*config_files)
+    # the comparison is only meaningful if the cases differ
+    assert {outcome['result'] for outcome in serial_outcomes} == {'success', 'collision', 'timeout'}
+    assert len({outcome['time'] for outcome in serial_outcomes}) > 3
+    assert any(outcome['danger_dists'] for outcome in serial_outcomes)
+
+    env_config_file, policy_config_file, train_config_file = config_files
+    evaluator = ParallelEvaluator(2, POLICY, policy_config_file, env_config_file, train_config_file,
+                                  policy_settings={'safety_space': SAFETY_SPACE})
+    try:
+        parallel_outcomes = evaluator.run_cases('test', range(NUM_CASES))
+        parallel_summary = evaluator.run_k_episodes(NUM_CASES, 'test', env.time_limit, env.time_step,
+                                                    print_failure=True)
+    finally:
+        evaluator.close()
+
+    # exact comparison, every case gives the same episode in any process and the outcomes are merged in case order
+    assert parallel_outcomes == serial_outcomes
+    assert parallel_summary == serial_summary
+    assert summarize(parallel_outcomes, env.time_limit, env.time_step) == serial_summary
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from crowd_nav.utils.memory import ReplayMemory, PrioritizedReplayMemory
+
+CAPACITY = 100
+# not a multiple of the chunk size and smaller than the capacity
+SIZE = 37
+CHUNK_SIZE = 10
+
+
+def fill(memory, size, agent_num=5, state_dim=13):
+    torch.manual_seed(0)
+    start = 0
+    while start < size:
+        # episodes with different numbers of agents, so that the states are padded
+        length = min(8, size - start)
+        states = [torch.randn(agent_num - start % 3, state_dim) for _ in range(length)]
+        values = torch.randn(length, 1)
+        discounts = torch.rand(length, 1) if memory.lazy_targets else None
+        memory.push_batch(states, values, discounts)
+        start += length
+
+
+def assert_same_memory(memory, loaded):
+    assert len(loaded) == len(memory)
+    assert loaded.position == memory.position
+    for name, tensor in memory.storage().items():
+        assert torch.equal(loaded.storage()[name][:len(memory)], tensor[:len(memory)]), name
+
+
+def test_partially_filled_memory_round_trip(tmp_path):
+    for lazy_targets in [False, True]:
+        memory = ReplayMemory(CAPACITY, lazy_targets=lazy_targets)
+        fill(memory, SIZE)
+        directory = str(tmp_path / 'memory_{}'.format(lazy_targets))
+        memory.save(directory)
+
+        loaded = ReplayMemory(CAPACITY, lazy_targets=lazy_targets)
+        loaded.load(directory, chunk_size=CHUNK_SIZE)
+        assert not loaded.is_full()
+        assert_same_memory(memory, loaded)
+
+
+def test_prioritized_memory_round_trip(tmp_path):
+    memory = PrioritizedReplayMemory(CAPACITY)
+    fill(memory, SIZE)
+    memory.update_priorities(np.arange(0, SIZE, 2), np.linspace(0, 3, len(range(0, SIZE, 2))))
+    directory = str(tmp_path / 'memory')
+    memory.save(directory)
+
+    loaded = PrioritizedReplayMemory(CAPACITY)
+    loaded.load(directory, chunk_size=CHUNK_SIZE)
+    assert_same_memory(memory, loaded)
+    assert loaded.max_priority == memory.max_priority
+    np.testing.assert_array_equal(loaded.tree[np.arange(CAPACITY)], memory.tree[np.arange(CAPACITY)])
+    assert loaded.tree.total() == memory.tree.total()